@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+"""
+Render the missing derivatives (thumbnails and previews) of every
+screenshot in the library.
+
+"""
+from __future__ import with_statement
+
+import multiprocessing
+from contextlib import closing
+
+import derivatives
+import shotomatic
+
+def _make_derivatives(shot):
+    derivatives.make_derivatives(*shot)
+
+if __name__ == "__main__":
+    with closing(shotomatic.connect_db()) as db:
+        shots = db.execute('select user, filename from screenshots').fetchall()
+    print "Rendering derivatives of {0} screenshots".format(len(shots))
+    pool = multiprocessing.Pool()
+    for done, _ in enumerate(pool.imap_unordered(_make_derivatives, shots, 16)):
+        if (done + 1) % 100 == 0:
+            print "{0}/{1}".format(done + 1, len(shots))
+    pool.close()
+    pool.join()
+    print "Done."
@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+"""
+Load and latency benchmark of shot-O-matic behind each of its front ends.
+
+For every library size a synthetic library of USERS x SHOTS screenshots is
+built in a scratch directory with its own configuration. Each front end is
+started on a fresh copy of it and driven with a mix of gallery views, image
+fetches, logins and uploads at fixed concurrency levels. Throughput,
+latency percentiles and the peak RSS of the server processes are printed
+and saved as JSON, which --compare checks against an earlier run:
+    ./benchmark.py --users 10 --shots 100,10000 --concurrency 1,16
+    ./benchmark.py --compare benchmark-old.json --output benchmark-new.json
+
+The ``wsgi`` front end runs serve.wsgi in Werkzeug's threaded server,
+standing in for mod_wsgi.
+
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import math
+import time
+import errno
+import random
+import shutil
+import signal
+import socket
+import httplib
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from urllib import urlencode
+from contextlib import closing
+from cStringIO import StringIO
+from optparse import OptionParser, SUPPRESS_HELP
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FRONT_ENDS = {
+    'gevent': 'gevent_serve.py',
+    'tornado': 'tornado_serve.py',
+    'wsgi': 'serve.wsgi',
+}
+PASSWORD = 'benchmark'
+PERCENTILES = (50, 95, 99)
+
+# paths of a library relative to its directory, so libraries can be copied
+LIBRARY_CONFIG = """
+# benchmark library
+import os as _os
+_library = _os.path.dirname(_os.path.abspath(__file__))
+DATABASE = _os.path.join(_library, 'shotomatic.db')
+SCREENSHOTS_DIR = _os.path.join(_library, 'screenshots')
+SESSIONS_DIR = _os.path.join(_library, 'sessions')
+DERIVATIVES_DIR = _os.path.join(_library, 'derivatives')
+BLOBS_DIR = _os.path.join(SCREENSHOTS_DIR, '.blobs')
+PAGE_CACHE_DIR = _os.path.join(_library, 'pages')
+DEBUG = False
+"""
+
+
+################################################################################
+# Synthetic libraries
+def write_config(directory):
+    """Writes the configuration of a library in ``directory``."""
+    with open(os.path.join(ROOT, 'config-template.py')) as f:
+        template = f.read()
+    with open(os.path.join(directory, 'config.py'), 'w') as f:
+        f.write(template)
+        f.write(LIBRARY_CONFIG)
+    for name in ('screenshots', 'sessions', 'derivatives', 'pages'):
+        os.mkdir(os.path.join(directory, name))
+
+def use_library(directory):
+    """Makes ``import config`` load the configuration of a library."""
+    sys.path.insert(0, directory)
+    import config
+    if os.path.dirname(os.path.abspath(config.__file__)) != directory:
+        raise RuntimeError('{0} was imported instead of the benchmark '
+                           'configuration'.format(config.__file__))
+
+def make_image(rng, width, height):
+    """Returns a PNG that compresses roughly like a screenshot."""
+    from PIL import Image, ImageDraw
+    image = Image.new('RGB', (width, height),
+                      tuple(rng.randrange(256) for i in range(3)))
+    draw = ImageDraw.Draw(image)
+    for i in range(300):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([x, y, x + rng.randrange(width // 4 + 1),
+                        y + rng.randrange(height // 20 + 1)],
+                       fill=tuple(rng.randrange(256) for i in range(3)))
+    f = StringIO()
+    image.save(f, 'PNG')
+    return f.getvalue()
+
+def build_library(directory, users, shots, sizes, seed):
+    """
+    Fills the library in ``directory`` with ``users`` users of ``shots``
+    screenshots each, created at random times during the last year.
+
+    """
+    use_library(directory)
+    import config
+    import shotomatic
+    shotomatic.init_db()
+    rng = random.Random(seed)
+    images = [make_image(rng, width, height) for width, height in sizes]
+    now = int(time.time())
+    tokens = {}
+    with closing(shotomatic.connect_db()) as db:
+        for i in range(users):
+            name = 'user{0}'.format(i)
+            shotomatic._create_user(name, PASSWORD, db=db)
+            tokens[name] = shotomatic._issue_token(name, db=db)
+            for j in range(shots):
+                path = os.path.join(config.SCREENSHOTS_DIR, name,
+                                    'shot{0}.png'.format(j))
+                with open(path, 'wb') as f:
+                    f.write(rng.choice(images))
+                created = now - rng.randrange(365 * 24 * 60 * 60)
+                os.utime(path, (created, created))
+        shotomatic.rescan_screenshots(db)
+    with open(os.path.join(directory, 'library.json'), 'w') as f:
+        json.dump({'users': users, 'shots': shots, 'tokens': tokens}, f)
+
+
+################################################################################
+# Servers
+def serve(directory, front_end, port):
+    """Runs a front end on the library in ``directory``."""
+    use_library(directory)
+    os.chdir(ROOT)
+    script = os.path.join(ROOT, FRONT_ENDS[front_end])
+    if front_end == 'wsgi':
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietRequestHandler(WSGIRequestHandler):
+            def log_request(self, *args):
+                pass
+
+        namespace = {'__file__': script}
+        execfile(script, namespace)
+        make_server('127.0.0.1', port, namespace['application'],
+                    threaded=True,
+                    request_handler=QuietRequestHandler).serve_forever()
+    else:
+        sys.argv = [script, '--port={0}'.format(port)]
+        execfile(script, {'__name__': '__main__', '__file__': script})
+
+def run_self(args, **kwargs):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)] +
+                            args, cwd=ROOT, **kwargs)
+
+def start_server(directory, front_end, port, timeout=30):
+    """Starts a front end in its own process group and waits for it."""
+    log = open(os.path.join(directory, 'server.log'), 'w')
+    process = run_self(['--serve', front_end, '--library', directory,
+                        '--port', str(port)],
+                       stdout=log, stderr=subprocess.STDOUT,
+                       preexec_fn=os.setsid)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{0} exited, see {1}'.format(front_end,
+                                                              log.name))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError('{0} did not start listening'.format(front_end))
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    process.wait()
+
+def peak_rss(pid):
+    """
+    Returns the peak resident set size in KiB of a process and all of its
+    children, summed up, or None where /proc is not available.
+
+    """
+    parents = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(name)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        parents[int(name)] = int(stat.rsplit(')', 1)[1].split()[1])
+    pids, todo = set(), [pid]
+    while todo:
+        current = todo.pop()
+        pids.add(current)
+        todo.extend(child for child, parent in parents.iteritems()
+                    if parent == current and child not in pids)
+    total = 0
+    for current in pids:
+        try:
+            with open('/proc/{0}/status'.format(current)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except IOError:
+            pass
+    return total
+
+
+################################################################################
+# Load
+class Visitor(object):
+    """A simulated visitor with its own keep-alive connection."""
+
+    def __init__(self, port, library, upload_image, rng, timeout):
+        self.port = port
+        self.library = library
+        self.upload_image = upload_image
+        self.rng = rng
+        self.uploads = 0
+        self.connection = httplib.HTTPConnection('127.0.0.1', port,
+                                                 timeout=timeout)
+
+    def random_shot(self):
+        return ('user{0}'.format(self.rng.randrange(self.library['users'])),
+                'shot{0}.png'.format(self.rng.randrange(self.library['shots'])))
+
+    def view(self):
+        user = 'user{0}'.format(self.rng.randrange(self.library['users']))
+        return 'GET', self.rng.choice(['/', '/?all=1', '/' + user]), None, {}
+
+    def image(self):
+        user, shot = self.random_shot()
+        size = self.rng.choice(['shot', 'thumb'])
+        return 'GET', '/{0}/{1}/{2}'.format(user, size, shot), None, {}
+
+    def login(self):
+        user = 'user{0}'.format(self.rng.randrange(self.library['users']))
+        body = urlencode({'username': user, 'password': PASSWORD})
+        return 'POST', '/login', body, {
+            'Content-Type': 'application/x-www-form-urlencoded'}
+
+    def upload(self):
+        user = 'user{0}'.format(self.rng.randrange(self.library['users']))
+        self.uploads += 1
+        filename = 'bench-{0}-{1}-{2}.png'.format(
+            os.getpid(), threading.current_thread().ident, self.uploads)
+        boundary = 'shotomatic-benchmark-boundary'
+        body = '\r\n'.join([
+            '--' + boundary,
+            'Content-Disposition: form-data; name="screenshot"; '
+            'filename="{0}"'.format(filename),
+            'Content-Type: image/png',
+            '',
+            self.upload_image,
+            '--' + boundary + '--',
+            ''])
+        return 'POST', '/api/upload', body, {
+            'Content-Type': 'multipart/form-data; boundary=' + boundary,
+            'X-Api-Token': self.library['tokens'][user]}
+
+    def request(self, action):
+        """Does one ``action`` and returns its latency and success."""
+        method, path, body, headers = getattr(self, action)()
+        start = time.time()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+            ok = response.status < 400
+            if response.getheader('connection', '').lower() == 'close':
+                self.connection.close()
+        except (httplib.HTTPException, EnvironmentError):
+            self.connection.close()
+            ok = False
+        return time.time() - start, ok
+
+def run_visitors(args):
+    """Runs visitors in threads until ``deadline``, returns their samples."""
+    directory, port, mix, visitors, deadline, timeout, seed = args
+    with open(os.path.join(directory, 'library.json')) as f:
+        library = json.load(f)
+    with open(os.path.join(directory, 'screenshots', 'user0',
+                           'shot0.png'), 'rb') as f:
+        upload_image = f.read()
+    actions = []
+    for action, weight in mix:
+        actions.extend([action] * weight)
+    samples = []
+    lock = threading.Lock()
+
+    def visit(rng):
+        visitor = Visitor(port, library, upload_image, rng, timeout)
+        own = []
+        while time.time() < deadline:
+            action = rng.choice(actions)
+            latency, ok = visitor.request(action)
+            own.append((action, latency, ok))
+        with lock:
+            samples.extend(own)
+
+    threads = [threading.Thread(target=visit,
+                                args=(random.Random(seed * 1000 + i),))
+               for i in range(visitors)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+def run_load(directory, port, options, concurrency, duration):
+    """Runs ``concurrency`` visitors for ``duration`` seconds."""
+    processes = min(options.client_processes, concurrency)
+    deadline = time.time() + duration
+    jobs = [(directory, port, options.mix,
+             concurrency // processes + (i < concurrency % processes),
+             deadline, options.timeout, options.seed * 100 + i)
+            for i in range(processes)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        samples = []
+        for part in pool.map(run_visitors, jobs):
+            samples.extend(part)
+    finally:
+        pool.close()
+        pool.join()
+    return samples
+
+
+################################################################################
+# Results
+def percentile(values, p):
+    """The nearest-rank percentile of sorted ``values``."""
+    index = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'requests': 0}
+    summary = {'requests': len(latencies),
+               'mean_ms': 1000 * sum(latencies) / len(latencies),
+               'max_ms': 1000 * latencies[-1]}
+    for p in PERCENTILES:
+        summary['p{0}_ms'.format(p)] = 1000 * percentile(latencies, p)
+    return summary
+
+def evaluate(samples, duration):
+    by_action = {}
+    for action, latency, ok in samples:
+        by_action.setdefault(action, []).append(latency)
+    latency = dict((action, summarize(latencies))
+                   for action, latencies in by_action.iteritems())
+    latency['all'] = summarize([sample[1] for sample in samples])
+    return {'requests': len(samples),
+            'errors': len([sample for sample in samples if not sample[2]]),
+            'throughput': len(samples) / float(duration),
+            'latency': latency}
+
+def result_key(result):
+    return (result['front_end'], result['users'], result['shots'],
+            result['concurrency'])
+
+def format_result(result):
+    latency = result['latency']['all']
+    return ('{front_end:8} {users:>5}x{shots:<6} c={concurrency:<4} '
+            '{throughput:8.1f} req/s  p50 {p50:7.1f}ms  p95 {p95:7.1f}ms  '
+            'p99 {p99:7.1f}ms  errors {errors}  rss {rss}').format(
+        p50=latency.get('p50_ms', 0), p95=latency.get('p95_ms', 0),
+        p99=latency.get('p99_ms', 0),
+        rss='{0:.1f}MiB'.format(result['peak_rss_kb'] / 1024.0)
+            if result['peak_rss_kb'] is not None else '?',
+        **result)
+
+def compare(baseline, results):
+    """Prints how throughput and p95 latency changed against a baseline."""
+    old = dict((result_key(result), result) for result in baseline['results'])
+    print "\nCompared to {0} ({1}):".format(baseline.get('revision'),
+                                           baseline.get('started'))
+    for result in results:
+        before = old.get(result_key(result))
+        if before is None or not before['throughput']:
+            continue
+        throughput = 100.0 * (result['throughput'] / before['throughput'] - 1)
+        line = '{0:8} {1:>5}x{2:<6} c={3:<4} throughput {4:+6.1f}%'.format(
+            *(result_key(result) + (throughput,)))
+        p95 = before['latency']['all'].get('p95_ms')
+        if p95:
+            line += '  p95 {0:+6.1f}%'.format(
+                100.0 * (result['latency']['all']['p95_ms'] / p95 - 1))
+        print line
+
+def revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        return None
+
+
+################################################################################
+# Main
+def parse_list(value, type=str):
+    return [type(item) for item in value.split(',') if item]
+
+def parse_mix(value):
+    mix = []
+    for item in parse_list(value):
+        action, _, weight = item.partition('=')
+        if action not in ('view', 'image', 'login', 'upload'):
+            raise ValueError('unknown action {0!r}'.format(action))
+        mix.append((action, int(weight or 1)))
+    return mix
+
+def run(options, directory):
+    results = []
+    for shots in options.shots:
+        base = os.path.join(directory, '{0}x{1}'.format(options.users, shots))
+        os.mkdir(base)
+        write_config(base)
+        print "Building a library of {0}x{1} screenshots".format(
+            options.users, shots)
+        builder = run_self(['--build-library', base,
+                            '--users', str(options.users),
+                            '--shots', str(shots),
+                            '--sizes', options.sizes,
+                            '--seed', str(options.seed)])
+        if builder.wait() != 0:
+            raise RuntimeError('building the library failed')
+
+        for front_end in options.front_ends:
+            library = os.path.join(directory, '{0}x{1}-{2}'.format(
+                options.users, shots, front_end))
+            shutil.copytree(base, library, symlinks=True)
+            server = start_server(library, front_end, options.port)
+            try:
+                if options.warmup:
+                    run_load(library, options.port, options,
+                             max(options.concurrency), options.warmup)
+                for concurrency in options.concurrency:
+                    samples = run_load(library, options.port, options,
+                                       concurrency, options.duration)
+                    result = {'front_end': front_end, 'users': options.users,
+                              'shots': shots, 'concurrency': concurrency,
+                              'duration': options.duration,
+                              'peak_rss_kb': peak_rss(server.pid)}
+                    result.update(evaluate(samples, options.duration))
+                    results.append(result)
+                    print format_result(result)
+            finally:
+                stop_server(server)
+    return results
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--front-ends", default="gevent,tornado,wsgi",
+                      help="front ends to benchmark [%default]")
+    parser.add_option("--users", type="int", default=10,
+                      help="users in the library [%default]")
+    parser.add_option("--shots", default="100",
+                      help="screenshots per user, a comma separated list "
+                           "benchmarks several library sizes [%default]")
+    parser.add_option("--sizes", default="1280x800,1920x1080",
+                      help="sizes of the screenshots [%default]")
+    parser.add_option("--concurrency", default="1,8,32",
+                      help="concurrent visitors [%default]")
+    parser.add_option("--duration", type="float", default=10,
+                      help="seconds per concurrency level [%default]")
+    parser.add_option("--warmup", type="float", default=2,
+                      help="seconds of load before measuring [%default]")
+    parser.add_option("--mix", default="view=60,image=30,login=5,upload=5",
+                      help="weights of the visitor actions [%default]")
+    parser.add_option("--client-processes", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="processes the visitors run in [%default]")
+    parser.add_option("--timeout", type="float", default=30,
+                      help="seconds until a request counts as failed "
+                           "[%default]")
+    parser.add_option("--port", type="int", default=5100,
+                      help="port the front ends listen on [%default]")
+    parser.add_option("--seed", type="int", default=1,
+                      help="seed of the library and the visitors [%default]")
+    parser.add_option("--dir", help="where to build the libraries, a "
+                                    "temporary directory by default")
+    parser.add_option("--output", help="JSON file to save the results to "
+                                       "[benchmark-<time>.json]")
+    parser.add_option("--compare", metavar="BASELINE",
+                      help="JSON file of an earlier run to compare with")
+    # used by the benchmark to run its own helper processes
+    parser.add_option("--build-library", help=SUPPRESS_HELP)
+    parser.add_option("--serve", help=SUPPRESS_HELP)
+    parser.add_option("--library", help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    try:
+        options.front_ends = parse_list(options.front_ends)
+        options.shots = parse_list(options.shots, int)
+        options.concurrency = parse_list(options.concurrency, int)
+        options.mix = parse_mix(options.mix)
+        sizes = [tuple(int(n) for n in size.split('x'))
+                 for size in parse_list(options.sizes)]
+    except ValueError, e:
+        parser.error(str(e))
+    if options.serve:
+        serve(os.path.abspath(options.library), options.serve, options.port)
+        return
+    if options.build_library:
+        build_library(os.path.abspath(options.build_library), options.users,
+                      options.shots[0], sizes, options.seed)
+        return
+    unknown = set(options.front_ends) - set(FRONT_ENDS)
+    if unknown:
+        parser.error("unknown front ends: {0}".format(', '.join(unknown)))
+    if options.users < 1 or min(options.shots) < 1:
+        parser.error("the library needs at least one user and screenshot")
+    if not options.concurrency or min(options.concurrency) < 1:
+        parser.error("give concurrency levels of at least 1")
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    output = options.output or 'benchmark-{0}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S'))
+    if options.dir:
+        directory = os.path.abspath(options.dir)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        directory = tempfile.mkdtemp(dir=directory)
+    else:
+        directory = tempfile.mkdtemp(prefix='shotomatic-benchmark-')
+    try:
+        results = run(options, directory)
+    finally:
+        if not options.dir:
+            shutil.rmtree(directory, True)
+
+    with open(output, 'w') as f:
+        json.dump({'started': started,
+                   'revision': revision(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'cpus': multiprocessing.cpu_count(),
+                   'options': {'users': options.users,
+                               'shots': options.shots,
+                               'sizes': options.sizes,
+                               'concurrency': options.concurrency,
+                               'duration': options.duration,
+                               'warmup': options.warmup,
+                               'mix': dict(options.mix),
+                               'client_processes': options.client_processes,
+                               'timeout': options.timeout,
+                               'seed': options.seed},
+                   'results': results}, f, indent=2, sort_keys=True)
+    print "Results saved to {0}".format(output)
+    if baseline is not None:
+        compare(baseline, results)
+
+if __name__ == "__main__":
+    main()
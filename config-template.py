@@ -7,3 +7,89 @@ DEBUG = False
 SECRET_KEY = 'secret key'
 DEFAULT_USERNAME = 'admin'
 DEFAULT_PASSWORD = 'default'
+SCREENSHOTS_PER_PAGE = 10
+SCREENSHOTS_PER_PAGE_ALL = 100
+DERIVATIVES_DIR = '/path/to/derivatives/dir'
+# name -> bounding box of the downscaled versions shown in the gallery
+DERIVATIVE_SIZES = {'thumb': (470, 470), 'preview': (1280, 1280)}
+DERIVATIVE_QUALITY = 80
+# how long clients cache screenshots whose URL carries their current version
+SCREENSHOT_CACHE_TIMEOUT = 60 * 60 * 24 * 365
+SCREENSHOT_CACHE_IMMUTABLE = True
+# None to send screenshots from Python, 'X-Sendfile' (Apache, lighttpd) or
+# 'X-Accel-Redirect' (nginx) to leave it to the fronting web server. For
+# nginx, map ACCEL_REDIRECT_PREFIX to the file system root in an internal
+# location, e.g. "location /_files/ { internal; alias /; }"
+SENDFILE = None
+ACCEL_REDIRECT_PREFIX = '/_files'
+# largest request body accepted, uploads are spooled to disk as they arrive
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+# 'filesystem' keeps sessions in SESSIONS_DIR with an in-memory cache in
+# front, 'cookie' keeps them in the signed session cookie only, which needs
+# no shared state between processes
+SESSION_STORE = 'filesystem'
+SESSION_CACHE_SIZE = 1000
+# seconds between writing changed sessions to disk, 0 writes immediately;
+# use 0 when several processes share SESSIONS_DIR
+SESSION_FLUSH_INTERVAL = 5
+# seconds between removing expired session files
+SESSION_SWEEP_INTERVAL = 60 * 60
+# idle connections kept open per process
+DATABASE_POOL_SIZE = 8
+# SQLite page cache per connection, negative values are KiB
+DATABASE_CACHE_SIZE = -16000
+# seconds after which a query is logged as slow, None to disable
+SLOW_QUERY_THRESHOLD = 0.1
+# seconds a verified API token is trusted without asking the database
+API_TOKEN_CACHE_TTL = 60
+# 'directories' stores uploads as plain files in the user directories,
+# 'content-addressed' stores every distinct screenshot once in BLOBS_DIR
+# and hard links it into the user directories (see migrate_storage.py)
+STORAGE = 'directories'
+# must be on the same file system as SCREENSHOTS_DIR
+BLOBS_DIR = '/path/to/screenhots/dir/.blobs'
+# cache of rendered screenshot listings: 'memory' for each process on its
+# own, 'file' to share PAGE_CACHE_DIR between worker processes, or None
+PAGE_CACHE = 'memory'
+# bytes of rendered pages kept per cache
+PAGE_CACHE_SIZE = 16 * 1024 * 1024
+# e.g. a directory on /dev/shm to keep the shared cache in memory
+PAGE_CACHE_DIR = '/path/to/page/cache/dir'
+# requests taking longer than this many seconds are logged with the time
+# spent in each phase, for a SLOW_REQUEST_SAMPLE_RATE fraction of them
+SLOW_REQUEST_THRESHOLD = 1.0
+SLOW_REQUEST_SAMPLE_RATE = 0.1
+# processes gevent_serve.py and tornado_serve.py serve with, forked from a
+# master that replaces workers that die and starts new ones on SIGHUP; 0
+# serves from a single process. Workers need state they can share: set
+# PAGE_CACHE = 'file' (or None), as memory caches see the other workers'
+# changes only after JOB_POLL_INTERVAL, and SESSION_FLUSH_INTERVAL = 0 (or
+# SESSION_STORE = 'cookie'); /metrics answers for one worker at a time,
+# labelled with its process id
+SERVER_WORKERS = 0
+# connections each gevent worker serves at once
+GEVENT_POOL_SIZE = 100
+# threads running the app in each Tornado worker
+TORNADO_THREADS = 10
+# seconds stopping workers get to finish their requests before being killed
+GRACEFUL_TIMEOUT = 30
+# seconds job_worker.py waits before looking for new jobs again, also how
+# often servers with PAGE_CACHE = 'memory' look for listings jobs changed
+JOB_POLL_INTERVAL = 1
+# runs of a failing job before it is given up; the first retry waits
+# JOB_RETRY_DELAY seconds, every further one twice as long
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10
+# seconds a running job may go without reporting progress before it is
+# considered lost with its worker and run again
+JOB_TIMEOUT = 10 * 60
+# processes job_worker.py runs jobs in
+JOB_WORKERS = 2
+# recompress uploads losslessly and without metadata in job_worker.py,
+# keeping the result if it is smaller
+OPTIMIZE_UPLOADS = True
+# command recompressing JPEGs, None to leave them as they are
+JPEGTRAN = 'jpegtran'
+# bytes of screenshots new users may store, None for no limit; admins can
+# change the quota of every user on the users page
+DEFAULT_QUOTA = None
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic database pool
+    ~~~~~~
+
+    A pool of tuned SQLite connections that are shared between requests
+    instead of opening a new one for every request. Connections run in WAL
+    mode, so many readers can work against the database file while one
+    writer commits, and statements slower than a threshold are logged.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger('shotomatic')
+
+
+class TimedConnection(sqlite3.Connection):
+    """A connection that logs statements and commits above a threshold."""
+
+    #: seconds after which a statement is logged, None to never log
+    slow_query_threshold = None
+
+    def execute(self, sql, parameters=()):
+        start = time.time()
+        try:
+            return sqlite3.Connection.execute(self, sql, parameters)
+        finally:
+            self._log_if_slow(time.time() - start, sql, parameters)
+
+    def commit(self):
+        start = time.time()
+        try:
+            return sqlite3.Connection.commit(self)
+        finally:
+            self._log_if_slow(time.time() - start, 'commit')
+
+    def _log_if_slow(self, elapsed, sql, parameters=()):
+        threshold = self.slow_query_threshold
+        if threshold is not None and elapsed >= threshold:
+            logger.warning('slow query (%.1fms): %s %r', elapsed * 1000,
+                           sql, tuple(parameters))
+
+
+class ConnectionPool(object):
+    """
+    Hands out connections to ``database``, keeping up to ``max_idle`` of
+    them open for reuse. A connection is only ever used by one thread or
+    greenlet at a time, between :meth:`acquire` and :meth:`release`.
+
+    """
+
+    def __init__(self, database, max_idle=8, cache_size=-16000,
+                 cached_statements=200, timeout=10,
+                 slow_query_threshold=None):
+        self.database = database
+        self.max_idle = max_idle
+        self.cache_size = cache_size
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self.slow_query_threshold = slow_query_threshold
+        self._idle = []
+        self._lock = threading.Lock()
+        # connections must not be shared with forked children
+        self._pid = os.getpid()
+
+    def connect(self):
+        """Opens a new, tuned connection outside of the pool."""
+        db = sqlite3.connect(self.database, timeout=self.timeout,
+                             cached_statements=self.cached_statements,
+                             check_same_thread=False,
+                             factory=TimedConnection)
+        db.slow_query_threshold = self.slow_query_threshold
+        db.row_factory = sqlite3.Row
+        db.execute('pragma journal_mode=WAL')
+        db.execute('pragma synchronous=NORMAL')
+        db.execute('pragma cache_size={0:d}'.format(self.cache_size))
+        return db
+
+    def acquire(self):
+        """Returns an idle connection, or a new one if there is none."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = []
+            if self._idle:
+                return self._idle.pop()
+        return self.connect()
+
+    def release(self, db):
+        """Gives a connection back, rolling back what was not committed."""
+        try:
+            db.rollback()
+        except sqlite3.Error:
+            db.close()
+            return
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.max_idle:
+                self._idle.append(db)
+                return
+        db.close()
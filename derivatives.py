@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic derivatives
+    ~~~~~~
+
+    Downscaled JPEG versions of the uploaded screenshots, so the gallery
+    pages don't have to ship the full-size originals. Derivatives are
+    rendered by a ``make_derivatives`` job after an upload, or on the first
+    request for them if that has not happened yet.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+
+import os
+import errno
+import shutil
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+# configuration
+import config
+
+
+def derivative_path(size, user, shot):
+    """Returns where the ``size`` derivative of a screenshot is stored."""
+    return os.path.join(config.DERIVATIVES_DIR, size, user, shot + '.jpg')
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def make_derivative(size, user, shot):
+    """
+    Renders the ``size`` derivative of a screenshot and returns its path.
+    The image is written to a temporary file first and renamed into place,
+    so concurrent renderers never expose a half-written file.
+
+    """
+    image = Image.open(os.path.join(config.SCREENSHOTS_DIR, user, shot))
+    image.draft('RGB', config.DERIVATIVE_SIZES[size])
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail(config.DERIVATIVE_SIZES[size], Image.ANTIALIAS)
+
+    target = derivative_path(size, user, shot)
+    _makedirs(os.path.dirname(target))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, 'JPEG', quality=config.DERIVATIVE_QUALITY,
+                       optimize=True)
+        os.rename(tmp_path, target)
+    except:
+        os.remove(tmp_path)
+        raise
+    return target
+
+def make_derivatives(user, shot):
+    """Renders all derivatives of a screenshot that don't exist yet."""
+    for size in config.DERIVATIVE_SIZES:
+        if os.path.exists(derivative_path(size, user, shot)):
+            continue
+        try:
+            make_derivative(size, user, shot)
+        except IOError:
+            # not an image we can read, or it was deleted meanwhile;
+            # the original will be served in place of the derivative
+            return
+
+def derivative_dirs(user):
+    """Returns the directories holding the derivatives of a user."""
+    return [os.path.join(config.DERIVATIVES_DIR, size, user)
+            for size in config.DERIVATIVE_SIZES]
+
+def remove_derivatives(user, shot=None):
+    """Removes the derivatives of one screenshot, or of all of a user's."""
+    if shot is None:
+        for path in derivative_dirs(user):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        return
+    for size in config.DERIVATIVE_SIZES:
+        path = derivative_path(size, user, shot)
+        if os.path.exists(path):
+            os.remove(path)
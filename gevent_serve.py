@@ -8,9 +8,57 @@ activate_this = "env/bin/activate_this.py"
 if os.path.exists(activate_this):
     execfile(activate_this, dict(__file__=activate_this))
 
-from shotomatic import app
-from gevent import wsgi
+import signal
+import logging
+from optparse import OptionParser
 
-if __name__ == "__main__":
-    server = wsgi.WSGIServer(('', 5000), app, spawn=None)
+import config
+import prefork
+
+
+def serve(listener):
+    """Serves the app on ``listener`` until SIGTERM, then stops gracefully."""
+    # imported here, so that every worker loads the app after the fork
+    import gevent
+    from gevent.pool import Pool
+    # pywsgi writes response bodies as they are produced, the libevent based
+    # gevent.wsgi server buffers them completely
+    from gevent import pywsgi
+    from shotomatic import app
+
+    server = pywsgi.WSGIServer(listener, app,
+                               spawn=Pool(config.GEVENT_POOL_SIZE))
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    signal_handler(signal.SIGTERM, lambda: gevent.spawn(
+        server.stop, config.GRACEFUL_TIMEOUT))
     server.serve_forever()
+
+def reload_config():
+    # restored if the new settings can't be used, workers that die are
+    # replaced with the old ones then
+    settings = dict(vars(config))
+    reload(config)
+    problems = prefork.check_config()
+    if problems:
+        vars(config).update(settings)
+        raise RuntimeError('; '.join(problems))
+    return config.SERVER_WORKERS
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--port", type="int", default=5000,
+                      help="port to listen on [%default]")
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if config.SERVER_WORKERS > 0:
+        problems = prefork.check_config()
+        if problems:
+            raise SystemExit('Cannot serve with SERVER_WORKERS > 0:\n' +
+                             '\n'.join(problems))
+        master = prefork.Master(prefork.listen(options.port), serve,
+                                workers=config.SERVER_WORKERS,
+                                graceful_timeout=config.GRACEFUL_TIMEOUT,
+                                on_reload=reload_config)
+        master.run()
+    else:
+        serve(('', options.port))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Run the background jobs the application queues, e.g. removing the
+screenshots of deleted users or optimizing uploads. Start it next to the
+servers; it runs JOB_WORKERS processes, and several job workers can share
+the queue. With --once it runs the jobs that are due in one process and
+exits, e.g. from cron.
+
+"""
+import logging
+from optparse import OptionParser
+
+import config
+import jobs
+import prefork
+import shotomatic
+
+def make_worker():
+    return jobs.Worker(shotomatic.connect_db, shotomatic.job_handlers,
+                       poll_interval=config.JOB_POLL_INTERVAL,
+                       timeout=config.JOB_TIMEOUT,
+                       max_attempts=config.JOB_MAX_ATTEMPTS,
+                       retry_delay=config.JOB_RETRY_DELAY)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--once", action="store_true", default=False,
+                      help="exit when no job is due")
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if options.once or config.JOB_WORKERS <= 1:
+        make_worker().run(once=options.once)
+    else:
+        # workers are named after their process, so they are made after
+        # the fork; there is no socket to share
+        master = prefork.Master(None, lambda sock: make_worker().run(),
+                                workers=config.JOB_WORKERS,
+                                graceful_timeout=config.GRACEFUL_TIMEOUT)
+        master.run()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic jobs
+    ~~~~~~
+
+    A persistent queue of background jobs kept in the ``jobs`` table of
+    the database, for work that takes too long to do within a request:
+    reclaiming the storage of deleted users, rescans, bulk imports and
+    storage statistics. Requests enqueue jobs and ``job_worker.py`` runs
+    them, reporting their progress in the table.
+
+    Failing jobs are retried with backoff, and the jobs of a worker that
+    died are run again once they stop reporting progress. So a job may run
+    more than once and has to be idempotent.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import json
+import signal
+import socket
+import sqlite3
+import logging
+import traceback
+
+logger = logging.getLogger('shotomatic')
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def enqueue(db, kind, args=None, key=None):
+    """
+    Adds a job that calls the handler ``kind`` with the keyword ``args``
+    and returns its id. The job is added in the current transaction, so it
+    runs once the caller commits. If an unfinished job with the same
+    ``key`` exists, its id is returned instead of adding another.
+
+    """
+    if key is not None:
+        job = db.execute('select id from jobs where key=? and state in (?, ?)',
+                         [key, PENDING, RUNNING]).fetchone()
+        if job is not None:
+            return job['id']
+    now = time.time()
+    cursor = db.execute('insert into jobs (kind, args, key, state, attempts, '
+                        'done, total, created, run_after) '
+                        'VALUES(?, ?, ?, ?, 0, 0, 0, ?, ?)',
+                        [kind, json.dumps(args or {}), key, PENDING, now, now])
+    return cursor.lastrowid
+
+def claim(db, worker):
+    """Marks the next due job as run by ``worker`` and returns it, or None."""
+    now = time.time()
+    cursor = db.execute('update jobs set state=?, worker=?, '
+                        'attempts=attempts + 1, started=?, updated=? '
+                        'where id = (select id from jobs where state=? and '
+                        'run_after <= ? order by run_after, id limit 1)',
+                        [RUNNING, worker, now, now, PENDING, now])
+    db.commit()
+    if not cursor.rowcount:
+        return None
+    return db.execute('select * from jobs where state=? and worker=?',
+                      [RUNNING, worker]).fetchone()
+
+def progress(db, id, done, total):
+    db.execute('update jobs set done=?, total=?, updated=? where id=?',
+               [done, total, time.time(), id])
+    db.commit()
+
+def finish(db, id, result=None):
+    now = time.time()
+    db.execute('update jobs set state=?, result=?, error=NULL, updated=?, '
+               'finished=? where id=?',
+               [DONE, None if result is None else json.dumps(result),
+                now, now, id])
+    db.commit()
+
+def fail(db, job, error, max_attempts=5, retry_delay=10):
+    """
+    Records that a run of ``job`` failed. It is run again after a delay
+    that doubles with every attempt, until ``max_attempts`` runs failed.
+
+    """
+    now = time.time()
+    if job['attempts'] < max_attempts:
+        db.execute('update jobs set state=?, error=?, updated=?, run_after=? '
+                   'where id=?',
+                   [PENDING, error, now,
+                    now + retry_delay * 2 ** (job['attempts'] - 1), job['id']])
+    else:
+        db.execute('update jobs set state=?, error=?, updated=?, finished=? '
+                   'where id=?', [FAILED, error, now, now, job['id']])
+    db.commit()
+
+def retry(db, id):
+    """Runs a failed job again, with all of its attempts."""
+    db.execute('update jobs set state=?, attempts=0, run_after=?, '
+               'finished=NULL where id=? and state=?',
+               [PENDING, time.time(), id, FAILED])
+    db.commit()
+
+def recover(db, timeout, max_attempts=5, retry_delay=10):
+    """
+    Fails the running jobs that did not report progress for ``timeout``
+    seconds, as their worker most likely died.
+
+    """
+    lost = db.execute('select * from jobs where state=? and updated < ?',
+                      [RUNNING, time.time() - timeout]).fetchall()
+    for job in lost:
+        logger.warning('job %d (%s) of %s was lost, failing it', job['id'],
+                       job['kind'], job['worker'])
+        fail(db, job, 'Lost with worker {0}.'.format(job['worker']),
+             max_attempts, retry_delay)
+
+def recent(db, limit=20):
+    """Returns the newest jobs, with their arguments and results decoded."""
+    rv = []
+    for job in db.execute('select * from jobs order by id desc limit ?',
+                          [limit]):
+        job = dict(zip(job.keys(), job))
+        job['args'] = json.loads(job['args'])
+        if job['result'] is not None:
+            job['result'] = json.loads(job['result'])
+        rv.append(job)
+    return rv
+
+
+class Worker(object):
+    """
+    Runs the jobs of the queue one after another, calling the handler
+    registered for their kind in ``handlers`` as
+    ``handler(db, report, **args)``. Handlers call ``report(done, total)``
+    to record their progress and may return a JSON serializable result.
+    ``SIGTERM`` stops the worker after the job it is running.
+
+    """
+
+    def __init__(self, connect, handlers, poll_interval=1, timeout=600,
+                 max_attempts=5, retry_delay=10, report_interval=1):
+        self.connect = connect
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.report_interval = report_interval
+        self.name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self._stopping = False
+
+    def run(self, once=False):
+        """Runs jobs until stopped, or until none is due with ``once``."""
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        db = self.connect()
+        logger.info('job worker %s started', self.name)
+        try:
+            while not self._stopping:
+                try:
+                    recover(db, self.timeout, self.max_attempts,
+                            self.retry_delay)
+                    job = claim(db, self.name)
+                except sqlite3.OperationalError, e:
+                    # another worker holds the write lock, try again later
+                    db.rollback()
+                    logger.debug('claiming a job failed: %s', e)
+                    job = None
+                if job is not None:
+                    self.run_job(db, job)
+                elif once:
+                    break
+                else:
+                    time.sleep(self.poll_interval)
+        finally:
+            db.close()
+        logger.info('job worker %s stopped', self.name)
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def run_job(self, db, job):
+        logger.info('running job %d (%s), attempt %d', job['id'], job['kind'],
+                    job['attempts'])
+        last_report = [0]
+        def report(done, total):
+            now = time.time()
+            if done < total and now - last_report[0] < self.report_interval:
+                return
+            last_report[0] = now
+            progress(db, job['id'], done, total)
+        try:
+            handler = self.handlers[job['kind']]
+            result = handler(db, report, **json.loads(job['args']))
+        except Exception, e:
+            db.rollback()
+            logger.error('job %d (%s) failed:\n%s', job['id'], job['kind'],
+                         traceback.format_exc())
+            fail(db, job, '{0}: {1}'.format(e.__class__.__name__, e),
+                 self.max_attempts, self.retry_delay)
+        else:
+            finish(db, job['id'], result)
+            logger.info('job %d (%s) done', job['id'], job['kind'])
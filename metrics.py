@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic metrics
+    ~~~~~~
+
+    Counters and histograms kept in memory and exposed in the Prometheus
+    text format. Updating them takes a lock once per request, so they are
+    cheap enough to always be on. Every process keeps its own metrics, so
+    processes serving together label theirs with their process id.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+
+import os
+import threading
+
+#: upper bounds in seconds of the buckets of duration histograms
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.iteritems())) if labels else ()
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+                         .replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{' + ','.join(u'{0}="{1}"'.format(name, _escape(value))
+                          for name, value in labels) + '}'
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    """
+    Holds counters and histograms by name and labels. Metrics have to be
+    described before they are used. With ``process_label`` every sample
+    gets a label of that name with the id of the exposing process.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, process_label=None):
+        self.buckets = buckets
+        self.process_label = process_label
+        self._descriptions = []
+        self._kinds = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help):
+        """Adds a metric, ``kind`` is 'counter' or 'histogram'."""
+        assert kind in ('counter', 'histogram')
+        self._descriptions.append((name, kind, help))
+        self._kinds[name] = kind
+        self._values[name] = {}
+
+    def inc(self, name, labels=None, value=1):
+        self.update([(name, labels, value)])
+
+    def observe(self, name, labels=None, value=0.0):
+        self.update([(name, labels, value)])
+
+    def update(self, samples):
+        """
+        Applies ``(name, labels, value)`` samples at once, incrementing
+        counters and adding observations to histograms.
+
+        """
+        samples = [(name, _labels(labels), value)
+                   for name, labels, value in samples]
+        with self._lock:
+            for name, labels, value in samples:
+                values = self._values[name]
+                if self._kinds[name] == 'counter':
+                    values[labels] = values.get(labels, 0) + value
+                    continue
+                histogram = values.get(labels)
+                if histogram is None:
+                    # bucket counts, then the sum and count of observations
+                    histogram = values[labels] = [0] * len(self.buckets) + \
+                                                 [0.0, 0]
+                for i, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        histogram[i] += 1
+                        break
+                histogram[-2] += value
+                histogram[-1] += 1
+
+    def exposition(self):
+        """Returns all metrics in the Prometheus text format."""
+        with self._lock:
+            values = dict((name, sorted((labels, list(value)
+                                         if isinstance(value, list) else value)
+                                        for labels, value in v.iteritems()))
+                          for name, v in self._values.iteritems())
+        process = ()
+        if self.process_label is not None:
+            process = ((self.process_label, os.getpid()),)
+        lines = []
+        for name, kind, help in self._descriptions:
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in values[name]:
+                labels += process
+                if kind == 'counter':
+                    lines.append(u'{0}{1} {2}'.format(
+                        name, _format_labels(labels), _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, value):
+                    cumulative += count
+                    lines.append(u'{0}_bucket{1} {2}'.format(
+                        name, _format_labels(labels, (('le', repr(bound)),)),
+                        cumulative))
+                lines.append(u'{0}_bucket{1} {2}'.format(
+                    name, _format_labels(labels, (('le', '+Inf'),)),
+                    value[-1]))
+                lines.append(u'{0}_sum{1} {2}'.format(
+                    name, _format_labels(labels), repr(value[-2])))
+                lines.append(u'{0}_count{1} {2}'.format(
+                    name, _format_labels(labels), value[-1]))
+        return u'\n'.join(lines) + u'\n'
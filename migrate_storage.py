@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Convert an existing library to content-addressed storage in place: every
+screenshot is hashed, stored once in BLOBS_DIR and the user files are
+replaced with hard links to their blobs. Set STORAGE = 'content-addressed'
+in the configuration before running it; it can be run again safely.
+
+"""
+from __future__ import with_statement
+
+import os
+from contextlib import closing
+
+import config
+import storage
+import shotomatic
+
+if __name__ == "__main__":
+    if not storage.content_addressed():
+        raise SystemExit("STORAGE is not set to 'content-addressed'")
+    with closing(shotomatic.connect_db()) as db:
+        shotomatic.upgrade_db(db)
+        shotomatic.rescan_screenshots(db)
+        shots = db.execute('select id, user, filename from screenshots '
+                           'order by id').fetchall()
+        print "Migrating {0} screenshots to '{1}'".format(len(shots),
+                                                          config.BLOBS_DIR)
+        for done, shot in enumerate(shots):
+            path = os.path.join(config.SCREENSHOTS_DIR, shot['user'],
+                                shot['filename'])
+            hash = storage.hash_file(path)
+            storage.adopt(path, hash)
+            db.execute('update screenshots set hash=? where id=?',
+                       [hash, shot['id']])
+            if (done + 1) % 100 == 0:
+                db.commit()
+                print "{0}/{1}".format(done + 1, len(shots))
+        db.commit()
+    print "Done."
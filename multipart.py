@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic uploads
+    ~~~~~~
+
+    Spooling of uploaded files to disk while they arrive. Uploads are
+    written to hidden temporary files in the screenshots directory and
+    renamed into place once complete, so saving them never copies the
+    data again and a screenshot is never visible half-written.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import tempfile
+
+from werkzeug import MultiDict, FileStorage
+from werkzeug.http import parse_options_header
+
+# the longest header block of a single part we accept
+MAX_PART_HEADER_SIZE = 8 * 1024
+
+
+def spool_file(directory):
+    """
+    Returns a temporary file in ``directory`` to write an upload to. It is
+    removed again when closed, unless it was moved with :func:`save_upload`.
+
+    """
+    return tempfile.NamedTemporaryFile('w+b', prefix='.upload-',
+                                       dir=directory)
+
+def _rename_spooled(stream, target):
+    stream.flush()
+    os.rename(stream.name, target)
+    stream.delete = False
+    stream.close()
+    os.chmod(target, 0644)
+
+def save_upload(file, target):
+    """
+    Stores an uploaded :class:`~werkzeug.FileStorage` at ``target``. Files
+    spooled on the same file system are renamed into place, everything
+    else is copied to a temporary file next to ``target`` first.
+
+    """
+    stream = file.stream
+    if getattr(stream, 'delete', False):
+        try:
+            _rename_spooled(stream, target)
+            return
+        except OSError:
+            # not on the same file system
+            pass
+    tmp = spool_file(os.path.dirname(target))
+    file.save(tmp)
+    _rename_spooled(tmp, target)
+
+
+class MultipartParser(object):
+    """
+    Incremental parser for ``multipart/form-data`` bodies. The body is fed
+    in chunks as it arrives; file parts go to streams returned by
+    ``stream_factory`` right away, so no more than about one chunk of the
+    body is held in memory. Field values larger than ``max_field_size``
+    are rejected.
+
+    """
+
+    def __init__(self, boundary, stream_factory, charset='utf-8',
+                 max_field_size=500 * 1024):
+        self.delimiter = '\r\n--' + boundary
+        self.stream_factory = stream_factory
+        self.charset = charset
+        self.max_field_size = max_field_size
+        self.form = MultiDict()
+        self.files = MultiDict()
+        # the leading CRLF makes the first boundary look like all others
+        self._buffer = '\r\n'
+        self._state = 'preamble'
+        self._part = None
+
+    def feed(self, data):
+        """Parses the next chunk of the body, raises ValueError if broken."""
+        self._buffer += data
+        while self._step():
+            pass
+
+    def finish(self):
+        """Returns the ``(form, files)`` of a completely fed body."""
+        if self._state != 'epilogue':
+            self.close()
+            raise ValueError('multipart body ended unexpectedly')
+        return self.form, self.files
+
+    def close(self):
+        """Closes the streams of all file parts, e.g. after a failure."""
+        if self._part is not None and self._part['stream'] is not None:
+            self._part['stream'].close()
+        for name, file in self.files.iteritems(multi=True):
+            file.close()
+
+    def _step(self):
+        buffer = self._buffer
+        if self._state == 'preamble':
+            pos = buffer.find(self.delimiter)
+            if pos == -1:
+                self._buffer = buffer[-len(self.delimiter):]
+                return False
+            self._buffer = buffer[pos + len(self.delimiter):]
+            self._state = 'boundary'
+        elif self._state == 'boundary':
+            if len(buffer) < 2:
+                return False
+            if buffer.startswith('--'):
+                self._buffer = ''
+                self._state = 'epilogue'
+                return False
+            if not buffer.startswith('\r\n'):
+                raise ValueError('malformed multipart boundary')
+            self._buffer = buffer[2:]
+            self._state = 'headers'
+        elif self._state == 'headers':
+            pos = buffer.find('\r\n\r\n')
+            if pos == -1:
+                if len(buffer) > MAX_PART_HEADER_SIZE:
+                    raise ValueError('multipart headers too long')
+                return False
+            self._start_part(buffer[:pos])
+            self._buffer = buffer[pos + 4:]
+            self._state = 'body'
+        elif self._state == 'body':
+            pos = buffer.find(self.delimiter)
+            if pos == -1:
+                # keep what could be the start of a delimiter
+                keep = len(self.delimiter) - 1
+                if len(buffer) > keep:
+                    self._write(buffer[:-keep])
+                    self._buffer = buffer[-keep:]
+                return False
+            self._write(buffer[:pos])
+            self._end_part()
+            self._buffer = buffer[pos + len(self.delimiter):]
+            self._state = 'boundary'
+        else:
+            self._buffer = ''
+            return False
+        return True
+
+    def _start_part(self, header_block):
+        headers = {}
+        for line in header_block.split('\r\n'):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        disposition, options = parse_options_header(
+            headers.get('content-disposition', ''))
+        if disposition != 'form-data' or 'name' not in options:
+            raise ValueError('multipart part without form-data name')
+        self._part = part = {
+            'name': options['name'].decode(self.charset, 'replace'),
+            'size': 0,
+            'stream': None,
+            'chunks': [],
+        }
+        if 'filename' in options:
+            part['filename'] = options['filename'].decode(self.charset,
+                                                          'replace')
+            part['content_type'] = headers.get('content-type',
+                                               'application/octet-stream')
+            part['stream'] = self.stream_factory()
+
+    def _write(self, data):
+        if not data:
+            return
+        part = self._part
+        part['size'] += len(data)
+        if part['stream'] is not None:
+            part['stream'].write(data)
+        elif part['size'] > self.max_field_size:
+            raise ValueError('multipart field too large')
+        else:
+            part['chunks'].append(data)
+
+    def _end_part(self):
+        part, self._part = self._part, None
+        if part['stream'] is None:
+            value = ''.join(part['chunks']).decode(self.charset, 'replace')
+            self.form.add(part['name'], value)
+        else:
+            part['stream'].seek(0)
+            file = FileStorage(part['stream'], part['filename'], part['name'],
+                               part['content_type'], part['size'])
+            # FileStorage falls back to the spool file's name for empty ones
+            file.filename = part['filename']
+            self.files.add(part['name'], file)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic optimization
+    ~~~~~~
+
+    Lossless recompression of uploaded screenshots. PNGs are saved again
+    by PIL with the best compression and without text chunks and other
+    metadata, JPEGs are run through ``jpegtran``, which optimizes their
+    Huffman tables and drops the metadata without decoding them. The pixels
+    stay exactly the same.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import tempfile
+import subprocess
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+# configuration
+import config
+
+# modes PIL writes to PNG without changing the pixels
+PNG_MODES = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA')
+
+
+def _pixels(image):
+    # tostring was renamed to tobytes in Pillow
+    return (getattr(image, 'tobytes', None) or image.tostring)()
+
+def _optimize_png(image, path, target):
+    if image.mode not in PNG_MODES or getattr(image, 'is_animated', False):
+        return False
+    options = {'optimize': True}
+    for key in ('transparency', 'icc_profile'):
+        if key in image.info:
+            options[key] = image.info[key]
+    image.save(target, 'PNG', **options)
+    optimized = Image.open(target)
+    return optimized.mode == image.mode and \
+           optimized.getpalette() == image.getpalette() and \
+           _pixels(optimized) == _pixels(image)
+
+def _optimize_jpeg(image, path, target):
+    if not config.JPEGTRAN:
+        return False
+    try:
+        status = subprocess.call([config.JPEGTRAN, '-copy', 'none',
+                                  '-optimize', '-progressive',
+                                  '-outfile', target, path])
+    except OSError:
+        # jpegtran is not installed
+        return False
+    return status == 0
+
+optimizers = {
+    'PNG': _optimize_png,
+    'JPEG': _optimize_jpeg,
+}
+
+def optimize(path):
+    """
+    Recompresses the image at ``path`` and returns the path of the result,
+    a temporary file next to it, if that is smaller. Returns None if the
+    image is not smaller or cannot be optimized.
+
+    """
+    try:
+        image = Image.open(path)
+        image.load()
+    except IOError:
+        return None
+    optimizer = optimizers.get(image.format)
+    if optimizer is None:
+        return None
+    fd, target = tempfile.mkstemp(prefix='.optimize-',
+                                  dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        if optimizer(image, path, target) and \
+                os.path.getsize(target) < os.path.getsize(path):
+            # readable like the uploads, e.g. by a web server with SENDFILE
+            os.chmod(target, 0644)
+            return target
+    except (IOError, ValueError):
+        pass
+    os.remove(target)
+    return None
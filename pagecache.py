@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic page cache
+    ~~~~~~
+
+    Keeps rendered pages and page fragments around until the data they
+    show changes. Every cached page depends on a few named scopes, e.g.
+    the screenshots of one user, and its key includes the current
+    generation of each of them. Changing the data bumps the generations of
+    the affected scopes, so exactly the pages showing it are rendered anew
+    and the old entries age out of the cache.
+
+    The entries and generations live in a backend: :class:`MemoryBackend`
+    for a single process, or :class:`FileBackend` for several worker
+    processes sharing a directory (put it on a tmpfs like ``/dev/shm`` to
+    share it in memory).
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+
+import os
+import time
+import errno
+import hashlib
+import threading
+from collections import OrderedDict
+
+# the scope every key depends on, bumped to drop the whole cache
+ALL = '*'
+
+
+class Page(object):
+    """A cached page with the validators to answer conditional requests."""
+
+    __slots__ = ('body', 'etag', 'last_modified')
+
+    def __init__(self, body, etag, last_modified):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def dumps(self):
+        return '{0} {1:d}\n{2}'.format(self.etag, self.last_modified,
+                                       self.body)
+
+    @classmethod
+    def loads(cls, value):
+        header, body = value.split('\n', 1)
+        etag, last_modified = header.split(' ')
+        return cls(body, etag, int(last_modified))
+
+
+class NullBackend(object):
+    """Caches nothing, for running without a page cache."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def generations(self, scopes):
+        return [0] * len(scopes)
+
+    def bump(self, scope):
+        pass
+
+
+class MemoryBackend(object):
+    """
+    Keeps entries in memory, evicting the least recently used ones once
+    they take up more than ``max_size`` bytes.
+
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_size and self._entries:
+                self._size -= len(self._entries.popitem(last=False)[1])
+
+    def generations(self, scopes):
+        with self._lock:
+            return [self._generations.get(scope, 0) for scope in scopes]
+
+    def bump(self, scope):
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+
+
+class FileBackend(object):
+    """
+    Keeps entries as files in ``path``, which several processes can share.
+    Reading an entry touches its file, and every ``prune_interval`` writes
+    the least recently used files are removed until the entries take up at
+    most ``max_size`` bytes again.
+
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024, prune_interval=100):
+        self.path = path
+        self.max_size = max_size
+        self.prune_interval = prune_interval
+        self._pages_dir = os.path.join(path, 'pages')
+        self._generations_dir = os.path.join(path, 'generations')
+        for directory in (self._pages_dir, self._generations_dir):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._writes = 0
+
+    def _filename(self, directory, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(directory, hashlib.md5(key).hexdigest())
+
+    def _read(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, filename, value):
+        tmp = '{0}.{1}-{2}'.format(filename, os.getpid(),
+                                   threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(value)
+        os.rename(tmp, filename)
+
+    def get(self, key):
+        filename = self._filename(self._pages_dir, key)
+        value = self._read(filename)
+        if value is not None:
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value):
+        self._write(self._filename(self._pages_dir, key), value)
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def prune(self):
+        """Removes least recently used entries down to ``max_size``."""
+        entries = []
+        for name in os.listdir(self._pages_dir):
+            filename = os.path.join(self._pages_dir, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        total = sum(size for mtime, size, filename in entries)
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def generations(self, scopes):
+        return [self._read(self._filename(self._generations_dir, scope)) or ''
+                for scope in scopes]
+
+    def bump(self, scope):
+        # a random generation instead of a counter, so processes bumping
+        # at the same time don't need to agree on the next number
+        self._write(self._filename(self._generations_dir, scope),
+                    os.urandom(8).encode('hex'))
+
+
+class PageCache(object):
+    """Caches rendered pages and fragments in ``backend``."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def key(self, scopes, *parts):
+        """
+        Returns the key of a page that shows ``parts`` and depends on the
+        data of ``scopes``; it changes when one of them is invalidated.
+
+        """
+        scopes = [ALL] + list(scopes)
+        return repr((parts, self.backend.generations(scopes)))
+
+    def get(self, key):
+        """Returns the cached :class:`Page` for ``key``, or None."""
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        return Page.loads(value)
+
+    def set(self, key, body):
+        """Caches the rendered ``body`` of a page and returns its Page."""
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        page = Page(body, hashlib.md5(body).hexdigest(), int(time.time()))
+        self.backend.set(key, page.dumps())
+        return page
+
+    def fragment(self, key, render):
+        """
+        Returns the cached fragment for ``key``, calling ``render`` to
+        create it if there is none. Fragment keys should include whatever
+        the fragment shows, as there is no scope to invalidate them by.
+
+        """
+        value = self.backend.get(key)
+        if value is None:
+            value = render()
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            self.backend.set(key, value)
+        return value.decode('utf-8')
+
+    def invalidate(self, *scopes):
+        """Makes all pages depending on one of ``scopes`` render anew."""
+        for scope in scopes:
+            self.backend.bump(scope)
+
+    def clear(self):
+        """Makes all pages render anew."""
+        self.backend.bump(ALL)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic pre-fork serving
+    ~~~~~~
+
+    A master process that opens the listening socket and forks worker
+    processes that all accept connections from it, so requests are served
+    on several cores. Workers that die are replaced. ``SIGHUP`` reloads:
+    new workers are started, which import the application anew, and the
+    old ones are stopped gracefully. ``SIGTERM`` and ``SIGINT`` stop all
+    workers gracefully and then the master.
+
+    Workers get ``SIGTERM`` to stop and should stop accepting, finish the
+    requests in progress and return from the worker function. Workers that
+    take longer than the graceful timeout are killed.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import traceback
+
+# configuration
+import config
+
+logger = logging.getLogger('shotomatic')
+
+
+def listen(port, host='', backlog=128):
+    """
+    Returns a socket listening on ``port``, to be shared by workers. It is
+    non-blocking, as all workers are woken up for a new connection but only
+    one of them gets it.
+
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+
+def check_config():
+    """
+    Returns what in the configuration only works when the application is
+    served by a single process, an empty list if nothing does.
+
+    """
+    problems = []
+    # memory caches learn of other processes' invalidations through the
+    # page_generations table, but only every JOB_POLL_INTERVAL; another
+    # worker would still serve the listing a user was just redirected to
+    # after uploading without the upload
+    if config.PAGE_CACHE == 'memory':
+        problems.append("PAGE_CACHE = 'memory' lags behind the other "
+                        "workers' changes, use 'file' or None")
+    if config.SESSION_STORE == 'filesystem' and \
+            config.SESSION_FLUSH_INTERVAL > 0:
+        problems.append("SESSION_FLUSH_INTERVAL must be 0 for workers to "
+                        "see each other's sessions, or use "
+                        "SESSION_STORE = 'cookie'")
+    return problems
+
+
+class Master(object):
+    """
+    Keeps ``workers`` processes running ``worker(sock)``. ``on_reload`` is
+    called on ``SIGHUP`` before new workers are started and may return a
+    new number of workers; if it raises, the old workers are kept.
+
+    """
+
+    def __init__(self, sock, worker, workers=2, graceful_timeout=30,
+                 on_reload=None):
+        self.sock = sock
+        self.worker = worker
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.on_reload = on_reload
+        # pid -> start time of the current workers, and of those stopping
+        self._children = {}
+        self._retiring = {}
+        self._stopping = False
+        self._reloading = False
+        self._respawn_delay = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        # only there to interrupt the sleep below
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        logger.info('master %d serving with %d workers', os.getpid(),
+                    self.workers)
+        while not self._stopping:
+            if self._reloading:
+                self._reload()
+            self._reap()
+            while len(self._children) < self.workers and not self._stopping:
+                self._spawn()
+            while len(self._children) > self.workers:
+                pid = self._children.popitem()[0]
+                self._retire(pid)
+            time.sleep(1)
+        self._stop()
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self._reloading = True
+
+    def _spawn(self):
+        if self._respawn_delay:
+            time.sleep(self._respawn_delay)
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.time()
+            return
+        # in the worker
+        for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        # a ^C reaches the whole process group, the master stops us then
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            self.worker(self.sock)
+        except SystemExit, e:
+            status = e.code if isinstance(e.code, int) else 1
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _retire(self, pid):
+        """Asks a worker to stop after the requests it is serving."""
+        self._retiring[pid] = time.time()
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _reap(self):
+        """Collects exited workers and kills retiring ones taking too long."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            started = self._children.pop(pid, None)
+            if self._retiring.pop(pid, None) is not None or started is None:
+                continue
+            logger.warning('worker %d exited with status %d, replacing it',
+                           pid, status)
+            # don't fork as fast as we can if workers die right away
+            if time.time() - started < 1:
+                self._respawn_delay = min(self._respawn_delay * 2 or 0.1, 5)
+            else:
+                self._respawn_delay = 0
+        deadline = time.time() - self.graceful_timeout
+        for pid, retired in self._retiring.items():
+            if retired < deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def _reload(self):
+        self._reloading = False
+        if self.on_reload is not None:
+            try:
+                workers = self.on_reload()
+            except Exception:
+                logger.exception('reloading failed, keeping the workers')
+                return
+            if workers is not None:
+                self.workers = workers
+        logger.info('master %d reloading with %d workers', os.getpid(),
+                    self.workers)
+        old = self._children.keys()
+        self._children = {}
+        for i in range(self.workers):
+            self._spawn()
+        for pid in old:
+            self._retire(pid)
+
+    def _stop(self):
+        for pid in self._children.keys():
+            self._retire(pid)
+        self._children = {}
+        while self._retiring:
+            self._reap()
+            time.sleep(0.1)
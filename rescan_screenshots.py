@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+"""
+Reconcile the screenshots table with the screenshot directories, e.g. to
+backfill a library that existed before the table did.
+
+"""
+from __future__ import with_statement
+
+from contextlib import closing
+
+import config
+import shotomatic
+
+if __name__ == "__main__":
+    with closing(shotomatic.connect_db()) as db:
+        shotomatic.upgrade_db(db)
+        counts = shotomatic.rescan_screenshots(db)
+    print "Rescanned '{0}': {1} added, {2} removed, {3} updated".format(
+        config.SCREENSHOTS_DIR, counts['added'], counts['removed'],
+        counts['updated'])
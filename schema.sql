@@ -1,7 +1,68 @@
 drop table if exists users;
-create table users (
+drop table if exists screenshots;
+drop table if exists api_tokens;
+drop table if exists jobs;
+drop table if exists page_generations;
+
+create table if not exists users (
   name string unique not null,
   password string not null,
   admin boolean not null,
-  screenshots_dir string
+  screenshots_dir string,
+  screenshots integer not null default 0,
+  bytes integer not null default 0,
+  quota integer
 );
+
+create table if not exists screenshots (
+  id integer primary key autoincrement,
+  user string not null,
+  filename string not null,
+  size integer not null,
+  mtime integer not null,
+  created integer not null,
+  hash string,
+  original_size integer,
+  original_hash string,
+  unique (user, filename)
+);
+create index if not exists screenshots_created_user
+  on screenshots (created, user);
+create index if not exists screenshots_user_created
+  on screenshots (user, created);
+create index if not exists screenshots_hash on screenshots (hash);
+
+create table if not exists api_tokens (
+  id integer primary key autoincrement,
+  user string not null,
+  token_hash string unique not null,
+  created integer not null
+);
+
+create table if not exists jobs (
+  id integer primary key autoincrement,
+  kind string not null,
+  args string not null,
+  key string,
+  state string not null,
+  attempts integer not null,
+  done integer not null,
+  total integer not null,
+  result string,
+  error string,
+  worker string,
+  created real not null,
+  run_after real not null,
+  started real,
+  updated real,
+  finished real
+);
+create index if not exists jobs_state_run_after on jobs (state, run_after);
+create index if not exists jobs_key on jobs (key);
+
+create table if not exists page_generations (
+  scope string primary key,
+  generation integer not null
+);
+create index if not exists page_generations_generation
+  on page_generations (generation);
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic sessions
+    ~~~~~~
+
+    A filesystem session store with a bounded in-memory cache in front of
+    it, so the session of a returning visitor is not unpickled from disk on
+    every request. Changed sessions are written back by a background
+    thread, which also removes expired session files now and then.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+
+import os
+import time
+import atexit
+import threading
+from collections import OrderedDict
+
+from werkzeug.contrib.sessions import FilesystemSessionStore
+
+
+class CachedSessionStore(FilesystemSessionStore):
+    """
+    Keeps the data of up to ``max_entries`` sessions in memory, evicting
+    the least recently used ones. Saved sessions are written to disk every
+    ``flush_interval`` seconds (immediately with 0), and every
+    ``sweep_interval`` seconds session files that have not been written
+    for ``lifetime`` seconds are removed.
+
+    """
+
+    def __init__(self, path, max_entries=1000, flush_interval=5,
+                 sweep_interval=3600, lifetime=31 * 24 * 60 * 60):
+        FilesystemSessionStore.__init__(self, path)
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.lifetime = lifetime
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._next_sweep = time.time()
+        # the maintenance thread does not survive a fork, so we remember
+        # which process started it
+        self._pid = None
+        atexit.register(self.flush)
+
+    def get(self, sid):
+        if not self.is_valid_key(sid):
+            return self.new()
+        self._ensure_thread()
+        with self._lock:
+            data = self._cache.pop(sid, None)
+            if data is not None:
+                self._cache[sid] = data
+        if data is None:
+            # a missing file may only not be written by another process
+            # yet, so its empty session is not remembered
+            exists = os.path.exists(self.get_session_filename(sid))
+            session = FilesystemSessionStore.get(self, sid)
+            if exists and session.sid == sid:
+                self._remember(sid, dict(session))
+            return session
+        return self.session_class(dict(data), sid, False)
+
+    def save(self, session):
+        self._ensure_thread()
+        self._remember(session.sid, dict(session),
+                       dirty=self.flush_interval > 0)
+        if self.flush_interval <= 0:
+            FilesystemSessionStore.save(self, session)
+
+    def delete(self, session):
+        with self._lock:
+            self._cache.pop(session.sid, None)
+            self._dirty.discard(session.sid)
+        FilesystemSessionStore.delete(self, session)
+
+    def flush(self):
+        """Writes all sessions that changed since the last flush to disk."""
+        with self._lock:
+            dirty = [(sid, self._cache[sid]) for sid in self._dirty]
+            self._dirty.clear()
+        for sid, data in dirty:
+            self._write(sid, data)
+
+    def sweep(self):
+        """Removes the files (and cache entries) of expired sessions."""
+        cutoff = time.time() - self.lifetime
+        for sid in self.list():
+            filename = self.get_session_filename(sid)
+            try:
+                if os.path.getmtime(filename) >= cutoff:
+                    continue
+                os.unlink(filename)
+            except OSError:
+                continue
+            with self._lock:
+                self._cache.pop(sid, None)
+
+    def _write(self, sid, data):
+        FilesystemSessionStore.save(self, self.session_class(data, sid, False))
+
+    def _remember(self, sid, data, dirty=False):
+        evicted = []
+        with self._lock:
+            self._cache.pop(sid, None)
+            self._cache[sid] = data
+            if dirty:
+                self._dirty.add(sid)
+            while len(self._cache) > self.max_entries:
+                old_sid, old_data = self._cache.popitem(last=False)
+                if old_sid in self._dirty:
+                    self._dirty.discard(old_sid)
+                    evicted.append((old_sid, old_data))
+        for old_sid, old_data in evicted:
+            self._write(old_sid, old_data)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._cache.clear()
+            self._dirty.clear()
+        interval = self.flush_interval or self.sweep_interval
+        if interval > 0:
+            thread = threading.Thread(target=self._maintain, args=(interval,))
+            thread.daemon = True
+            thread.start()
+
+    def _maintain(self, interval):
+        while True:
+            time.sleep(interval)
+            self.flush()
+            if self.sweep_interval > 0 and time.time() >= self._next_sweep:
+                self._next_sweep = time.time() + self.sweep_interval
+                self.sweep()
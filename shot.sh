@@ -15,6 +15,8 @@
   #SERVER="http://127.0.0.1:5000"
   USERNAME="aljoscha"
   PASSWORD="indra7"
+  # API token from the users page, used instead of the password if set
+  TOKEN=""
   UPLOAD_SCRIPT=/home/aljoscha/.apps/upload_screenshot.py
   FILENAME="`date +%y%m%d-%H%M%S`.jpg"
   TMPPATH=/tmp
@@ -72,7 +74,11 @@ out() {
     echo "$(date +"%m.%d.%y - %H:%M:%S"): $(whoami)" >> LOGFILE
   fi
 # send it to the host
-  $UPLOAD_SCRIPT $SERVER/upload $TMPPATH/$FILENAME $USERNAME $PASSWORD
+  if [[ ! -z "$TOKEN" ]]; then
+    $UPLOAD_SCRIPT $SERVER/api/upload $TMPPATH/$FILENAME $TOKEN
+  else
+    $UPLOAD_SCRIPT $SERVER/upload $TMPPATH/$FILENAME $USERNAME $PASSWORD
+  fi
   check "upload"
 # remove the tmp file
   rm $TMPPATH/$FILENAME 
@@ -12,40 +12,221 @@
 from __future__ import with_statement
 
 import os
+import time
+import json
+import random
+import mimetypes
 import shutil
-import glob
-import sqlite3
-from contextlib import closing
+from contextlib import closing, contextmanager
+from datetime import datetime
 # for our decorators
 from functools import wraps 
 
-from flask import Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash, send_file
+from cStringIO import StringIO
+
+from flask import Flask, Request, request, session, g, redirect, url_for, \
+     abort, flash, jsonify, Markup, _request_ctx_stack
+from flask import render_template as flask_render_template
 from werkzeug import SharedDataMiddleware
-from werkzeug import secure_filename
+from werkzeug import wrap_file, http_date, quote_etag, is_resource_modified
+from werkzeug import secure_filename, FileStorage
 from werkzeug import generate_password_hash, check_password_hash
-from werkzeug.contrib.sessions import FilesystemSessionStore
 
 # configuration
 import config
+import dbpool
+import derivatives
+import jobs
+import metrics
+import optimize
+import pagecache
+import sessions
+import storage
+import tokens
+
+
+class ShotRequest(Request):
+    """
+    Spools uploaded files to the screenshots directory, so saving them is
+    a rename. Front ends that already parsed and spooled the form (see
+    tornado_wsgi.py) pass it in the environ instead of the raw body.
+
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return storage.spool_file(config.SCREENSHOTS_DIR)
+
+    def _load_form_data(self):
+        if 'shotomatic.form' in self.environ and 'stream' not in self.__dict__:
+            self.__dict__['stream'] = StringIO()
+            self.__dict__['form'] = self.environ['shotomatic.form']
+            self.__dict__['files'] = self.environ['shotomatic.files']
+            return
+        Request._load_form_data(self)
+
 
 app = Flask(__name__)
+app.request_class = ShotRequest
 app.secret_key = config.SECRET_KEY
 app.debug = config.DEBUG
+app.config['MAX_CONTENT_LENGTH'] = config.MAX_UPLOAD_SIZE
+
+if config.SESSION_STORE == 'filesystem':
+    lifetime = app.permanent_session_lifetime
+    session_store = sessions.CachedSessionStore(
+        config.SESSIONS_DIR,
+        max_entries=config.SESSION_CACHE_SIZE,
+        flush_interval=config.SESSION_FLUSH_INTERVAL,
+        sweep_interval=config.SESSION_SWEEP_INTERVAL,
+        lifetime=lifetime.days * 24 * 60 * 60 + lifetime.seconds)
+else:
+    session_store = None
+
+
+################################################################################
+# Metrics
+# the workers of a pre-fork server each answer for themselves
+registry = metrics.Registry(
+    process_label='worker' if config.SERVER_WORKERS > 0 else None)
+registry.describe('shotomatic_requests_total', 'counter',
+                  'Requests handled, by endpoint and status.')
+registry.describe('shotomatic_request_duration_seconds', 'histogram',
+                  'Time spent handling requests, by endpoint.')
+registry.describe('shotomatic_phase_duration_seconds', 'histogram',
+                  'Time spent in the phases of requests, by endpoint.')
+registry.describe('shotomatic_response_bytes_total', 'counter',
+                  'Bytes of response bodies sent by the app or left to the '
+                  'web server with SENDFILE, by endpoint.')
+registry.describe('shotomatic_uploads_total', 'counter',
+                  'Uploaded screenshots, by result.')
+registry.describe('shotomatic_upload_bytes_total', 'counter',
+                  'Bytes of stored screenshot uploads.')
+registry.describe('shotomatic_cache_requests_total', 'counter',
+                  'Cache lookups, by cache and result.')
+
+def count(name, labels=None, value=1):
+    """
+    Increments a counter. During a request the increment is kept until the
+    request is recorded, so the registry is only locked once per request.
+
+    """
+    samples = getattr(g, 'samples', None) \
+              if _request_ctx_stack.top is not None else None
+    if samples is None:
+        registry.inc(name, labels, value)
+    else:
+        samples.append((name, labels, value))
+
+def count_cache(cache, hit):
+    count('shotomatic_cache_requests_total',
+          {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+def record_phase(phase, elapsed):
+    """Adds time spent in ``phase`` to the current request, if any."""
+    if _request_ctx_stack.top is None:
+        return
+    phases = getattr(g, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + elapsed
+
+@contextmanager
+def timed(phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.time() - start)
+
+def render_template(template_name, **context):
+    """Renders a template, timing it as the ``render`` phase."""
+    with timed('render'):
+        return flask_render_template(template_name, **context)
+
+def check_password(user, password):
+    with timed('password_check'):
+        return check_password_hash(user['password'], password)
+
+def response_length(response):
+    """
+    The length of the body the app sends, or leaves to the web server to
+    send, None if it is unknown.
+
+    """
+    if request.method == 'HEAD' or response.status_code == 304:
+        return 0
+    sendfile_length = getattr(g, 'sendfile_length', None)
+    if sendfile_length is not None:
+        return sendfile_length
+    length = response.headers.get('Content-Length')
+    if length is not None:
+        return int(length)
+    if not response.is_streamed:
+        return len(response.data)
+    return None
+
+def record_request(response):
+    """
+    Records the metrics of the finished request and logs its phases if it
+    was slow, for a sample of slow requests.
+
+    """
+    elapsed = time.time() - g.started
+    endpoint = request.endpoint or 'none'
+    samples = g.samples
+    samples.append(('shotomatic_requests_total',
+                    {'endpoint': endpoint, 'status': response.status_code}, 1))
+    samples.append(('shotomatic_request_duration_seconds',
+                    {'endpoint': endpoint}, elapsed))
+    for phase, duration in g.phases.iteritems():
+        samples.append(('shotomatic_phase_duration_seconds',
+                        {'endpoint': endpoint, 'phase': phase}, duration))
+    length = response_length(response)
+    if length:
+        samples.append(('shotomatic_response_bytes_total',
+                        {'endpoint': endpoint}, length))
+    registry.update(samples)
+
+    threshold = config.SLOW_REQUEST_THRESHOLD
+    if threshold is not None and elapsed >= threshold and \
+            random.random() < config.SLOW_REQUEST_SAMPLE_RATE:
+        phases = sorted(g.phases.iteritems(), key=lambda item: -item[1])
+        phases.append(('other', elapsed - sum(g.phases.itervalues())))
+        app.logger.warning('slow request (%.1fms): %s %s -> %d [%s]',
+                           elapsed * 1000, request.method, request.path,
+                           response.status_code,
+                           ', '.join('{0} {1:.1f}ms'.format(phase, t * 1000)
+                                     for phase, t in phases))
 
 
 ################################################################################
 # DB stuff
+db_pool = dbpool.ConnectionPool(config.DATABASE,
+                                 max_idle=config.DATABASE_POOL_SIZE,
+                                 cache_size=config.DATABASE_CACHE_SIZE,
+                                 slow_query_threshold=config.SLOW_QUERY_THRESHOLD)
+
 def connect_db():
     """Returns a new connection to the database."""
-    return sqlite3.connect(config.DATABASE)
+    return db_pool.connect()
+
+def get_db():
+    """
+    Returns the connection of the current request, taking one from the
+    pool on first use so requests without queries never touch it.
+
+    """
+    db = getattr(g, '_db', None)
+    if db is None:
+        with timed('db_connect'):
+            db = g._db = db_pool.acquire()
+    return db
 
 def query_db(query, args=(), one=False, db=None):
     if db is None:
-        db = g.db
-    cur = db.execute(query, args)
-    rv = [dict((cur.description[idx][0], value)
-               for idx, value in enumerate(row)) for row in cur.fetchall()]
+        db = get_db()
+    with timed('db_query'):
+        rv = db.execute(query, args).fetchall()
     return (rv[0] if rv else None) if one else rv
 
 def user_exists(name):
@@ -57,10 +238,12 @@ def user_exists(name):
 
 def _create_user(name, password, admin=False, db=None):
     if db is None:
-        db = g.db
+        db = get_db()
 
-    db.execute('insert into users VALUES(?, ?, ?, NULL)',
-               [name, generate_password_hash(password),admin])
+    db.execute('insert into users (name, password, admin, quota) '
+               'VALUES(?, ?, ?, ?)',
+               [name, generate_password_hash(password), admin,
+                config.DEFAULT_QUOTA])
     user = query_db("select * from users where name=?", [name], one=True,
                                                                 db=db)
     screenshots_dir = user['name']
@@ -70,22 +253,34 @@ def _create_user(name, password, admin=False, db=None):
     db.execute("update users set screenshots_dir = ? where name=?",
                [screenshots_dir, name])
     db.commit()
+    invalidate_pages(listing_scopes(name), db)
 
 def _delete_user(name, db=None):
     if db is None:
-        db = g.db
+        db = get_db()
 
     user = query_db("select * from users where name=?", [name], one=True,
                                                                 db=db)
     if user is None:
         return
 
+    hashes = query_db('select distinct hash from screenshots where user=? '
+                      'and hash is not null', [name], db=db)
+    # the files are only moved aside here, removing them can take long
+    # and is left to a job
     abs_path = os.path.join(config.SCREENSHOTS_DIR, user['screenshots_dir'])
-    if os.path.exists(abs_path):
-        shutil.rmtree(abs_path)
+    paths = [storage.trash(path) for path in
+             [abs_path] + derivatives.derivative_dirs(user['screenshots_dir'])]
 
+    db.execute('delete from screenshots where user=?', [name])
+    db.execute('delete from api_tokens where user=?', [name])
     db.execute('delete from users where name=?', [name])
+    jobs.enqueue(db, 'reclaim_storage',
+                 {'paths': [path for path in paths if path is not None],
+                  'hashes': [row['hash'] for row in hashes]})
     db.commit()
+    token_cache.discard_user(name)
+    invalidate_listings(name, db)
 
 
 def init_db():
@@ -99,46 +294,714 @@ def init_db():
                     admin=True,
                     db=db)
 
+# columns added to tables after they were first released, which creating
+# missing tables does not take care of
+added_columns = [
+    ('screenshots', 'hash', 'string'),
+    ('screenshots', 'original_size', 'integer'),
+    ('screenshots', 'original_hash', 'string'),
+    ('users', 'screenshots', 'integer not null default 0'),
+    ('users', 'bytes', 'integer not null default 0'),
+    ('users', 'quota', 'integer'),
+]
+
+def upgrade_db(db):
+    """
+    Creates the tables, columns and indexes from the schema that are
+    missing in an existing database, leaving the existing ones and their
+    data alone.
+
+    """
+    added = set()
+    for table, column, definition in added_columns:
+        columns = [row['name'] for row in
+                   db.execute('pragma table_info({0})'.format(table))]
+        if columns and column not in columns:
+            db.execute('alter table {0} add column {1} {2}'.format(
+                table, column, definition))
+            added.add(table)
+    db.commit()
+    with app.open_resource('schema.sql') as f:
+        script = ''.join(line for line in f if not line.startswith('drop '))
+    db.cursor().executescript(script)
+    if 'users' in added:
+        recount_users(db)
+
+def recount_users(db):
+    """
+    Computes the screenshot totals of all users from the screenshots table
+    anew, they are otherwise kept up to date as screenshots come and go.
+
+    """
+    db.execute('update users set '
+               'screenshots = (select count(*) from screenshots '
+               'where user = users.name), '
+               'bytes = (select coalesce(sum(size), 0) from screenshots '
+               'where user = users.name)')
+    db.commit()
+
+
+################################################################################
+# API tokens
+token_cache = tokens.TokenCache(ttl=config.API_TOKEN_CACHE_TTL)
+
+def _issue_token(name, db=None):
+    """Creates a new token for a user and returns it."""
+    if db is None:
+        db = get_db()
+
+    token = tokens.generate_token()
+    db.execute('insert into api_tokens (user, token_hash, created) '
+               'VALUES(?, ?, ?)',
+               [name, tokens.hash_token(token), int(time.time())])
+    db.commit()
+    return token
+
+def _revoke_token(name, id, db=None):
+    if db is None:
+        db = get_db()
+
+    token = query_db('select * from api_tokens where user=? and id=?',
+                     [name, id], one=True, db=db)
+    if token is None:
+        return
+    db.execute('delete from api_tokens where id=?', [id])
+    db.commit()
+    token_cache.discard(token['token_hash'])
+
+def user_for_token(token):
+    """Returns the session user a token belongs to, or None."""
+    token_hash = tokens.hash_token(token)
+    user = token_cache.get(token_hash)
+    count_cache('api_token', user is not None)
+    if user is None:
+        user = query_db('select users.* from api_tokens join users '
+                        'on api_tokens.user = users.name '
+                        'where token_hash=?', [token_hash], one=True)
+        if user is None:
+            return None
+        user = session_user(user)
+        token_cache.set(token_hash, user)
+    return user
+
+
+################################################################################
+# Screenshot catalog
+def _add_screenshot(user, filename, hash=None, created=None, db=None):
+    if db is None:
+        db = get_db()
+
+    st = os.stat(os.path.join(config.SCREENSHOTS_DIR, user, filename))
+    if created is None:
+        created = int(time.time())
+    old = query_db('select size from screenshots where user=? and '
+                   'filename=?', [user, filename], one=True, db=db)
+    db.execute('insert or replace into screenshots '
+               '(user, filename, size, mtime, created, hash, original_size, '
+               'original_hash) VALUES(?, ?, ?, ?, ?, ?, ?, ?)',
+               [user, filename, st.st_size, int(st.st_mtime), created, hash,
+                st.st_size, hash])
+    if old is None:
+        _count_screenshots(user, 1, st.st_size, db)
+    else:
+        _count_screenshots(user, 0, st.st_size - old['size'], db)
+    jobs.enqueue(db, 'make_derivatives', {'user': user, 'filename': filename},
+                 key='make_derivatives:{0}/{1}'.format(user, filename))
+    if config.OPTIMIZE_UPLOADS:
+        jobs.enqueue(db, 'optimize_screenshot',
+                     {'user': user, 'filename': filename},
+                     key='optimize_screenshot:{0}/{1}'.format(user, filename))
+    db.commit()
+    invalidate_listings(user, db)
+
+def _remove_screenshot(user, filename, db=None):
+    """Removes a screenshot's row and returns the hash of its blob."""
+    if db is None:
+        db = get_db()
+
+    shot = query_db('select size, hash from screenshots where user=? and '
+                    'filename=?', [user, filename], one=True, db=db)
+    db.execute('delete from screenshots where user=? and filename=?',
+               [user, filename])
+    if shot is not None:
+        _count_screenshots(user, -1, -shot['size'], db)
+    db.commit()
+    invalidate_listings(user, db)
+    return shot['hash'] if shot else None
+
+def _count_screenshots(user, screenshots, bytes, db):
+    """Adds to the screenshot totals of a user, in the caller's transaction."""
+    db.execute('update users set screenshots = screenshots + ?, '
+               'bytes = bytes + ? where name=?', [screenshots, bytes, user])
+
+def over_quota(user, filename, size):
+    """
+    Tells whether storing ``size`` bytes as ``filename`` would take a user
+    over quota, counting a screenshot it replaces as freed.
+
+    """
+    row = query_db('select users.bytes, users.quota, screenshots.size '
+                   'from users left join screenshots on '
+                   'screenshots.user = users.name and screenshots.filename = ? '
+                   'where users.name = ?', [filename, user], one=True)
+    if row is None or row['quota'] is None:
+        return False
+    return row['bytes'] - (row['size'] or 0) + size > row['quota']
+
+def make_cursor(shot):
+    return '{0}-{1}-{2}'.format(shot['created'], shot['user'], shot['id'])
+
+def parse_cursor(cursor):
+    """Splits a cursor into (created, user, id), None if it is malformed."""
+    try:
+        created, rest = cursor.split('-', 1)
+        user, id = rest.rsplit('-', 1)
+        return int(created), user, int(id)
+    except (AttributeError, ValueError):
+        return None
+
+def list_screenshots(user=None, before=None, limit=10, db=None):
+    """
+    Returns one page of screenshots, newest first, together with the cursor
+    for the next page (None on the last one). Pages are fetched by key from
+    the (created, user) index, so a page costs the same no matter how large
+    the library is.
+
+    """
+    where, args = [], []
+    if user is not None:
+        where.append('user = ?')
+        args.append(user)
+    before = parse_cursor(before)
+    if before is not None:
+        created, before_user, id = before
+        if user is None:
+            where.append('created <= ? and (created < ? or user < ? or '
+                         '(user = ? and id < ?))')
+            args.extend([created, created, before_user, before_user, id])
+        else:
+            where.append('created <= ? and (created < ? or id < ?)')
+            args.extend([created, created, id])
+    query = 'select * from screenshots'
+    if where:
+        query += ' where ' + ' and '.join(where)
+    if user is None:
+        query += ' order by created desc, user desc, id desc limit ?'
+    else:
+        query += ' order by created desc, id desc limit ?'
+    shots = query_db(query, args + [limit + 1], db=db)
+    if len(shots) > limit:
+        return shots[:limit], make_cursor(shots[limit - 1])
+    return shots, None
+
+def rescan_screenshots(db, report=None):
+    """
+    Brings the screenshots table in line with what is actually on disk:
+    adds rows for new files, drops rows whose file is gone and refreshes
+    the ones whose file changed. ``report(done, total)`` is called after
+    every user, if given. Returns how many rows were added, removed and
+    updated.
+
+    """
+    added = removed = updated = 0
+    users = query_db('select * from users', db=db)
+    for done, user in enumerate(users):
+        abs_path = os.path.join(config.SCREENSHOTS_DIR, user['screenshots_dir'])
+        on_disk = {}
+        if os.path.isdir(abs_path):
+            for filename in os.listdir(abs_path):
+                filepath = os.path.join(abs_path, filename)
+                # hidden files are temporaries of uploads and optimization
+                if not filename.startswith('.') and os.path.isfile(filepath):
+                    on_disk[filename] = os.stat(filepath)
+        known = query_db('select * from screenshots where user=?',
+                         [user['name']], db=db)
+        known = dict((shot['filename'], shot) for shot in known)
+
+        for filename, shot in known.iteritems():
+            if filename not in on_disk:
+                db.execute('delete from screenshots where id=?', [shot['id']])
+                removed += 1
+        for filename, st in on_disk.iteritems():
+            shot = known.get(filename)
+            if shot is None:
+                db.execute('insert into screenshots '
+                           '(user, filename, size, mtime, created) '
+                           'VALUES(?, ?, ?, ?, ?)',
+                           [user['name'], filename, st.st_size,
+                            int(st.st_mtime), int(st.st_mtime)])
+                added += 1
+            elif (shot['size'] != st.st_size or
+                    shot['mtime'] != int(st.st_mtime)):
+                db.execute('update screenshots set size=?, mtime=? where id=?',
+                           [st.st_size, int(st.st_mtime), shot['id']])
+                updated += 1
+        if report is not None:
+            report(done + 1, len(users))
+    db.commit()
+    if added or removed or updated:
+        recount_users(db)
+        invalidate_pages([pagecache.ALL], db)
+    app.logger.info('rescanned %s: %d added, %d removed, %d updated',
+                    config.SCREENSHOTS_DIR, added, removed, updated)
+    return {'added': added, 'removed': removed, 'updated': updated}
+
+
+################################################################################
+# Jobs
+def reclaim_storage(db, report, paths, hashes):
+    """Removes the files of a deleted user and the blobs they referenced."""
+    total = len(paths) + len(hashes)
+    for done, path in enumerate(paths):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        report(done + 1, total)
+    # only once the links in the user directory are gone
+    for done, hash in enumerate(hashes):
+        storage.release(hash)
+        report(len(paths) + done + 1, total)
+
+def import_screenshots(db, report, user, path):
+    """
+    Adds the screenshots in the server directory ``path`` to the library
+    of ``user``, skipping the ones the user already has.
+
+    """
+    names = sorted(name for name in os.listdir(path) if allowed_file(name)
+                   and os.path.isfile(os.path.join(path, name)))
+    imported = 0
+    for done, name in enumerate(names):
+        source = os.path.join(path, name)
+        filename = secure_filename(name)
+        target = os.path.join(config.SCREENSHOTS_DIR, user, filename)
+        st = os.stat(source)
+        old = query_db('select coalesce(original_size, size) as size, hash '
+                       'from screenshots where user=? and filename=?',
+                       [user, filename], one=True, db=db)
+        if old is None or old['size'] != st.st_size or \
+                not os.path.exists(target):
+            with open(source, 'rb') as f:
+                hash = storage.store(FileStorage(f, name), target)
+            derivatives.remove_derivatives(user, filename)
+            _add_screenshot(user, filename, hash, int(st.st_mtime), db=db)
+            if old is not None and old['hash'] != hash:
+                storage.release(old['hash'])
+            imported += 1
+        report(done + 1, len(names))
+    return {'imported': imported, 'skipped': len(names) - imported}
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+def make_derivatives(db, report, user, filename):
+    """
+    Renders the derivatives of an uploaded screenshot. If it is replaced
+    meanwhile they may show the old one, so they are removed again and
+    left to be rendered on demand.
+
+    """
+    path = os.path.join(config.SCREENSHOTS_DIR, user, filename)
+    state = _file_state(path)
+    if state is None:
+        return
+    derivatives.make_derivatives(user, filename)
+    if _file_state(path) != state:
+        derivatives.remove_derivatives(user, filename)
+    report(1, 1)
+
+def optimize_screenshot(db, report, user, filename):
+    """
+    Replaces a screenshot with its losslessly recompressed version if that
+    is smaller, keeping its modification time.
+
+    """
+    path = os.path.join(config.SCREENSHOTS_DIR, user, filename)
+    shot = query_db('select * from screenshots where user=? and filename=?',
+                    [user, filename], one=True, db=db)
+    if shot is None or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    optimized = optimize.optimize(path)
+    if optimized is None:
+        return {'saved': 0}
+    hash = None
+    if storage.content_addressed():
+        hash = storage.hash_file(optimized)
+        storage.adopt(optimized, hash)
+    os.utime(optimized, (st.st_atime, st.st_mtime))
+    new = os.stat(optimized)
+    current = os.stat(path)
+    if (current.st_ino, current.st_size, current.st_mtime) != \
+            (st.st_ino, st.st_size, st.st_mtime):
+        # replaced by an upload meanwhile, which is optimized on its own
+        os.remove(optimized)
+        storage.release(hash)
+        return None
+    os.rename(optimized, path)
+    db.execute('update screenshots set size=?, hash=? where id=?',
+               [new.st_size, hash, shot['id']])
+    _count_screenshots(user, 0, new.st_size - shot['size'], db)
+    db.commit()
+    invalidate_listings(user, db)
+    if shot['hash'] != hash:
+        storage.release(shot['hash'])
+    report(1, 1)
+    return {'saved': st.st_size - new.st_size}
+
+def storage_stats(db, report):
+    """
+    Computes the screenshot totals of all users anew and adds up the bytes
+    of the screenshots as uploaded, as they are now, and as stored on disk
+    with files shared between users counted only once.
+
+    """
+    recount_users(db)
+    users = query_db('select * from users', db=db)
+    inodes = {}
+    for done, user in enumerate(users):
+        abs_path = os.path.join(config.SCREENSHOTS_DIR, user['screenshots_dir'])
+        if os.path.isdir(abs_path):
+            for filename in os.listdir(abs_path):
+                if filename.startswith('.'):
+                    continue
+                st = os.stat(os.path.join(abs_path, filename))
+                inodes[st.st_dev, st.st_ino] = st.st_size
+        report(done + 1, len(users))
+    totals = query_db('select coalesce(sum(size), 0) as bytes, '
+                      'coalesce(sum(coalesce(original_size, size)), 0) '
+                      'as original_bytes from screenshots', one=True, db=db)
+    return {'bytes': totals['bytes'],
+            'original_bytes': totals['original_bytes'],
+            'stored_bytes': sum(inodes.itervalues())}
+
+def backfill_hashes(db, report, user):
+    """
+    Hashes the screenshots of ``user`` that were stored without a hash and
+    are unchanged since, for probes to compare them by content.
+
+    """
+    shots = query_db('select id, filename, size from screenshots '
+                     'where user=? and original_hash is null and hash is null '
+                     'and coalesce(original_size, size) = size',
+                     [user], db=db)
+    hashed = 0
+    for done, shot in enumerate(shots):
+        report(done, len(shots))
+        try:
+            hash = storage.hash_file(os.path.join(config.SCREENSHOTS_DIR,
+                                                  user, shot['filename']))
+        except IOError:
+            # removed meanwhile
+            continue
+        # the size guards against a replacement since the query
+        db.execute('update screenshots set original_hash=? '
+                   'where id=? and size=? and hash is null',
+                   [hash, shot['id'], shot['size']])
+        db.commit()
+        hashed += 1
+    report(len(shots), len(shots))
+    return {'hashed': hashed}
+
+# kind -> function running the jobs of that kind in job_worker.py
+job_handlers = {
+    'reclaim_storage': reclaim_storage,
+    'rescan_screenshots': rescan_screenshots,
+    'import_screenshots': import_screenshots,
+    'make_derivatives': make_derivatives,
+    'optimize_screenshot': optimize_screenshot,
+    'storage_stats': storage_stats,
+    'backfill_hashes': backfill_hashes,
+}
+
+
+################################################################################
+# Serving files
+class FileRange(object):
+    """Iterates over ``length`` bytes of a file, starting at ``start``."""
+
+    def __init__(self, file, start, length, buffer_size=64 * 1024):
+        self.file = file
+        self.remaining = length
+        self.buffer_size = buffer_size
+        file.seek(start)
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.remaining <= 0:
+            raise StopIteration()
+        data = self.file.read(min(self.buffer_size, self.remaining))
+        if not data:
+            raise StopIteration()
+        self.remaining -= len(data)
+        return data
+
+def parse_range(header, size):
+    """
+    Parses a single ``bytes=`` range into (start, stop), with stop being
+    exclusive. Returns None if the whole file should be sent instead and
+    False if the range cannot be satisfied.
+
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[6:].strip().partition('-')
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size
+        start = int(start)
+        end = int(end) + 1 if end else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        return False
+    return start, min(end, size)
+
+@app.template_filter('screenshot_version')
+def screenshot_version(shot):
+    """
+    The version of a screenshot row that its URLs carry as ``v``, changing
+    whenever the file is replaced or optimized.
+
+    """
+    return '{0:x}-{1:x}'.format(shot['mtime'], shot['size'])
+
+def file_version(filename):
+    """The :func:`screenshot_version` of the file at ``filename``."""
+    st = os.stat(filename)
+    return screenshot_version({'mtime': int(st.st_mtime),
+                               'size': st.st_size})
+
+def send_screenshot(filename, mimetype=None, version=None):
+    """
+    Sends a screenshot (or one of its derivatives) with a strong ETag,
+    answering conditional and range requests. Screenshots are replaced
+    under the same name, so only URLs whose ``v`` is the current
+    ``version`` of the screenshot are cached for long, all others are
+    revalidated. With ``SENDFILE`` configured the body is left to the
+    fronting web server.
+
+    """
+    st = os.stat(filename)
+    etag = '{0:x}-{1:x}-{2:x}'.format(st.st_ino, st.st_size,
+                                      int(st.st_mtime * 1000))
+    last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(filename)[0] or \
+                   'application/octet-stream'
+
+    rv = app.response_class(None, mimetype=mimetype, direct_passthrough=True)
+    rv.headers['ETag'] = quote_etag(etag)
+    rv.headers['Last-Modified'] = http_date(last_modified)
+    if version is not None and request.args.get('v') == version:
+        rv.headers['Cache-Control'] = 'public, max-age={0}'.format(
+            config.SCREENSHOT_CACHE_TIMEOUT)
+        if config.SCREENSHOT_CACHE_IMMUTABLE:
+            rv.headers['Cache-Control'] += ', immutable'
+    else:
+        rv.headers['Cache-Control'] = 'public, no-cache'
+    if not is_resource_modified(request.environ, quote_etag(etag),
+                                last_modified=last_modified):
+        rv.status_code = 304
+        return rv
+
+    if config.SENDFILE == 'X-Sendfile':
+        rv.headers['X-Sendfile'] = filename
+        g.sendfile_length = st.st_size
+        return rv
+    elif config.SENDFILE == 'X-Accel-Redirect':
+        rv.headers['X-Accel-Redirect'] = config.ACCEL_REDIRECT_PREFIX + \
+                                         os.path.abspath(filename)
+        g.sendfile_length = st.st_size
+        return rv
+
+    rv.headers['Accept-Ranges'] = 'bytes'
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if if_range is None or if_range == quote_etag(etag):
+        byte_range = parse_range(request.headers.get('Range'), st.st_size)
+    if byte_range is False:
+        rv.status_code = 416
+        rv.headers['Content-Range'] = 'bytes */{0}'.format(st.st_size)
+        return rv
+    if request.method == 'HEAD':
+        rv.headers['Content-Length'] = str(st.st_size)
+        return rv
+
+    f = open(filename, 'rb')
+    if byte_range is None:
+        rv.response = wrap_file(request.environ, f, 64 * 1024)
+        rv.headers['Content-Length'] = str(st.st_size)
+    else:
+        start, stop = byte_range
+        rv.response = FileRange(f, start, stop - start)
+        rv.status_code = 206
+        rv.headers['Content-Length'] = str(stop - start)
+        rv.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            start, stop - 1, st.st_size)
+    return rv
+
+
+################################################################################
+# Page cache
+if config.PAGE_CACHE == 'memory':
+    page_cache = pagecache.PageCache(
+        pagecache.MemoryBackend(config.PAGE_CACHE_SIZE))
+elif config.PAGE_CACHE == 'file':
+    page_cache = pagecache.PageCache(
+        pagecache.FileBackend(config.PAGE_CACHE_DIR, config.PAGE_CACHE_SIZE))
+else:
+    page_cache = pagecache.PageCache(pagecache.NullBackend())
+
+def listing_scopes(user=None):
+    """The cache scopes a listing of one user's (or all) screenshots uses."""
+    if user is None:
+        return ['screenshots']
+    return ['screenshots/' + user]
+
+def invalidate_pages(scopes, db=None):
+    """
+    Drops the cached pages of ``scopes``. A memory cache only sees what
+    its own process invalidates, so the scopes are also bumped in the
+    ``page_generations`` table, for the servers to pick up changes made
+    elsewhere, e.g. by jobs.
+
+    """
+    page_cache.invalidate(*scopes)
+    if not isinstance(page_cache.backend, pagecache.MemoryBackend):
+        return
+    if db is None:
+        db = get_db()
+    for scope in scopes:
+        db.execute('insert or replace into page_generations '
+                   '(scope, generation) select ?, '
+                   'coalesce(max(generation), 0) + 1 from page_generations',
+                   [scope])
+    db.commit()
+
+def invalidate_listings(user, db=None):
+    """Drops the cached listings that show screenshots of ``user``."""
+    invalidate_pages(listing_scopes() + listing_scopes(user), db)
+
+# when this process last looked for bumped scopes, and the newest
+# generation it saw
+_generations_checked = [0, None]
+
+def sync_page_cache():
+    """
+    Invalidates the scopes of a memory cache that other processes bumped
+    in the ``page_generations`` table since it last looked, which it does
+    at most every ``JOB_POLL_INTERVAL``.
+
+    """
+    if not isinstance(page_cache.backend, pagecache.MemoryBackend):
+        return
+    now = time.time()
+    if now - _generations_checked[0] < config.JOB_POLL_INTERVAL:
+        return
+    _generations_checked[0] = now
+    if _generations_checked[1] is None:
+        # nothing was cached from before the first look
+        newest = query_db('select max(generation) from page_generations',
+                          one=True)[0]
+        _generations_checked[1] = newest or 0
+        return
+    bumped = query_db('select scope, generation from page_generations '
+                      'where generation > ?', [_generations_checked[1]])
+    if bumped:
+        page_cache.invalidate(*[row['scope'] for row in bumped])
+        _generations_checked[1] = max(row['generation'] for row in bumped)
+
+def send_page(page):
+    """
+    Sends a cached page, or just a 304 if the browser has it already. The
+    page has to be revalidated every time, as it depends on the session.
+
+    """
+    last_modified = datetime.utcfromtimestamp(page.last_modified)
+    rv = app.response_class(None, mimetype='text/html')
+    rv.headers['ETag'] = quote_etag(page.etag)
+    rv.headers['Last-Modified'] = http_date(last_modified)
+    rv.headers['Cache-Control'] = 'private, no-cache'
+    rv.headers['Vary'] = 'Cookie'
+    if not is_resource_modified(request.environ, quote_etag(page.etag),
+                                last_modified=last_modified):
+        rv.status_code = 304
+    else:
+        rv.data = page.body
+    return rv
+
 
 ################################################################################
 # Per request stuff
+def session_user(user):
+    """The part of a user's row we keep in the session."""
+    return {'name': user['name'], 'admin': bool(user['admin'])}
+
 @app.before_request
 def before_request():
     """
-    Make sure we are connected to the database each request and also
-    do the session handling.
-    
+    Do the session handling, the database connection is only taken from
+    the pool once it is needed.
+
     """
-    g.db = connect_db()
-    session_store = FilesystemSessionStore(config.SESSIONS_DIR)
-    if 'sid' in session:
-        sid = session.get('sid')
-        g.session = session_store.get(sid)
-        if 'user' in g.session:
-            g.user = g.session['user']
-        else:
-            g.user = None
+    g.started = time.time()
+    g.phases = {}
+    g.samples = []
+    if session_store is None:
+        # stateless mode, everything lives in the signed session cookie
+        g.session = session
+    elif 'sid' in session:
+        with timed('session_load'):
+            g.session = session_store.get(session['sid'])
     else:
         g.session = session_store.new()
-        g.user = None
+    g.user = g.session.get('user')
 
 @app.after_request
 def after_request(response):
     """
-    Closes the database again at the end of the request and store the
-    session if neccessary.
+    Gives the database connection back to the pool at the end of the
+    request and store the session if neccessary.
     
     """
-    session_store = FilesystemSessionStore(config.SESSIONS_DIR)
-    if g.session.should_save:
-        session_store.save(g.session)
-        session['sid'] = g.session.sid
-        session.permanent = True
-        # we have to do this because Flask
-        # stores the SecureCookie containing the "Session"
-        # before calling the "after_request" functions
-        app.save_session(session, response)
-    g.db.close()
+    try:
+        # the session is missing if loading it failed
+        if session_store is not None and \
+                getattr(g, 'session', None) is not None and \
+                g.session.should_save:
+            with timed('session_save'):
+                session_store.save(g.session)
+                session['sid'] = g.session.sid
+                session.permanent = True
+                # we have to do this because Flask
+                # stores the SecureCookie containing the "Session"
+                # before calling the "after_request" functions
+                app.save_session(session, response)
+        # drop spooled uploads the view did not keep
+        if 'files' in request.__dict__:
+            for name, file in request.files.iteritems(multi=True):
+                file.close()
+    except Exception:
+        # Flask answers with a 500 then, without coming back here
+        record_request(app.response_class(status=500))
+        raise
+    finally:
+        db = getattr(g, '_db', None)
+        if db is not None:
+            db_pool.release(db)
+    record_request(response)
     return response
 
 
@@ -166,9 +1029,9 @@ def login_required(message="You must be logged in to access this section."):
                     user = query_db('select * from users where name = ?',
                                     [request.form['username']],
                                     one=True)
-                    if user and check_password_hash(user['password'],
-                                                    request.form['password']):
-                        g.user = user
+                    if user and check_password(user,
+                                               request.form['password']):
+                        g.user = session_user(user)
                         return f(*args, **kwargs)
                 flash(message, 'notice')
                 return redirect(url_for('login', next=request.url))
@@ -176,27 +1039,70 @@ def login_required(message="You must be logged in to access this section."):
         return decorated_function
     return decorator
 
+def api_error(message, status_code):
+    rv = jsonify(error=message)
+    rv.status_code = status_code
+    return rv
+
+def token_required(message="Invalid API token."):
+    """
+    For the API used by scripted clients: authenticates by the
+    ``X-Api-Token`` header instead of a session or password.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.user = user_for_token(request.headers.get('X-Api-Token', ''))
+            if g.user is None:
+                return api_error(message, 401)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 
 ################################################################################
 # Views
 @app.route('/<user>')
 @app.route('/')
 def show_screenshots(user=None):
-    if user is None:
-        users = glob.glob(os.path.join(config.SCREENSHOTS_DIR, '*'))
-        users = [os.path.basename(name) for name in users]
+    show_all = request.args.get('all', None)
+    before = request.args.get('before')
+    # flashed messages are shown only once, so such pages are not cached
+    if '_flashes' in session:
+        return render_screenshots(user, before, show_all)
+    sync_page_cache()
+    key = page_cache.key(listing_scopes(user), 'show_screenshots', user,
+                         before, show_all, g.user and g.user['name'])
+    page = page_cache.get(key)
+    count_cache('page', page is not None)
+    if page is None:
+        page = page_cache.set(key, render_screenshots(user, before, show_all))
+    return send_page(page)
+
+def render_screenshots(user, before, show_all):
+    if show_all is None:
+        per_page = config.SCREENSHOTS_PER_PAGE
     else:
-        users = [user]
-    screenshots = []
-    for user in users:
-        user_shots = glob.glob(os.path.join(config.SCREENSHOTS_DIR, user, '*'))
-        for user_shot in user_shots:
-            screenshots.append((user, os.path.basename(user_shot)))
-    screenshots.sort(reverse=True, cmp=lambda x,y: cmp(x[1], y[1]))
-    show_all = request.args.get('all', 0)
-    if show_all == 0:
-        screenshots = screenshots[:10]
-    return render_template('show_screenshots.html', screenshots=screenshots)
+        per_page = config.SCREENSHOTS_PER_PAGE_ALL
+    screenshots, next_cursor = list_screenshots(user, before, per_page)
+    tiles = [Markup(render_tile(shot)) for shot in screenshots]
+    return render_template('show_screenshots.html', tiles=tiles,
+                           user=user, show_all=show_all,
+                           next_cursor=next_cursor)
+
+def render_tile(shot):
+    """Returns the markup of one screenshot in a listing."""
+    key = repr(('screenshot_tile', shot['id'], shot['user'],
+                shot['filename'], shot['created'], shot['mtime'],
+                shot['size']))
+    rendered = []
+    def render():
+        rendered.append(True)
+        return render_template('screenshot_tile.html', shot=shot)
+    tile = page_cache.fragment(key, render)
+    count_cache('fragment', not rendered)
+    return tile
 
 @app.route('/<user>/shot/<shot>')
 def screenshot(user, shot):
@@ -206,29 +1112,188 @@ def screenshot(user, shot):
     if not os.path.exists(filename):
         flash("User {0} has not uploaded {1}.".format(user, shot), 'error')
         return redirect(url_for('show_screenshots'))
-    
-    return send_file(filename)
+
+    return send_screenshot(filename, version=file_version(filename))
+
+@app.route('/<user>/<any(thumb, preview):size>/<shot>')
+def screenshot_derivative(user, size, shot):
+    user = secure_filename(user)
+    shot = secure_filename(shot)
+    filename = derivatives.derivative_path(size, user, shot)
+    original = os.path.join(config.SCREENSHOTS_DIR, user, shot)
+    if not os.path.exists(original):
+        flash("User {0} has not uploaded {1}.".format(user, shot), 'error')
+        return redirect(url_for('show_screenshots'))
+    # derivatives are versioned by their original
+    version = file_version(original)
+    if not os.path.exists(filename):
+        try:
+            filename = derivatives.make_derivative(size, user, shot)
+        except IOError:
+            return send_screenshot(original, version=version)
+
+    return send_screenshot(filename, 'image/jpeg', version)
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in config.ALLOWED_EXTENSIONS
 
+def upload_size(file):
+    stream = file.stream
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def store_upload(file):
+    """
+    Stores an uploaded screenshot of the current user and returns its
+    filename, or None if this kind of file is not allowed.
+
+    """
+    if not file or not allowed_file(file.filename):
+        return None
+    filename = secure_filename(file.filename)
+    old = query_db('select hash from screenshots where user=? and '
+                   'filename=?', [g.user['name'], filename], one=True)
+    with timed('store'):
+        hash = storage.store(file, os.path.join(config.SCREENSHOTS_DIR,
+                                                g.user['name'],
+                                                filename))
+    # before the row is added, which queues rendering the new ones
+    derivatives.remove_derivatives(g.user['name'], filename)
+    _add_screenshot(g.user['name'], filename, hash)
+    if old is not None and old['hash'] != hash:
+        storage.release(old['hash'])
+    return filename
+
+def store_uploads(files):
+    """
+    Stores any number of uploaded screenshots of the current user and
+    returns a result dict for each, with either the URL or an error.
+
+    """
+    results = []
+    for file in files:
+        result = {'name': file.filename}
+        if file and over_quota(g.user['name'], secure_filename(file.filename),
+                               upload_size(file)):
+            result['error'] = 'Quota exceeded.'
+            count('shotomatic_uploads_total', {'result': 'over_quota'})
+            results.append(result)
+            continue
+        try:
+            filename = store_upload(file)
+        except EnvironmentError:
+            app.logger.exception('Storing upload %r failed', file.filename)
+            result['error'] = 'Screenshot could not be stored.'
+            count('shotomatic_uploads_total', {'result': 'failed'})
+        else:
+            if filename is None:
+                result['error'] = 'Uploads of this filetype not allowed.'
+                count('shotomatic_uploads_total', {'result': 'rejected'})
+            else:
+                result['filename'] = filename
+                result['url'] = url_for('screenshot', user=g.user['name'],
+                                        shot=filename, _external=True)
+                count('shotomatic_uploads_total', {'result': 'stored'})
+                count('shotomatic_upload_bytes_total', value=os.path.getsize(
+                    os.path.join(config.SCREENSHOTS_DIR, g.user['name'],
+                                 filename)))
+        results.append(result)
+    return results
+
 @app.route('/upload', methods=['POST', 'GET'])
 @login_required("You need to be logged in in order to upload screenshots.")
 def upload_screenshot():
     if request.method == 'POST':
-        file = request.files['screenshot']
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(config.SCREENSHOTS_DIR,
-                                   g.user['screenshots_dir'],
-                                   filename))
-            flash('Screenshot uploaded.', 'success')
+        results = store_uploads(request.files.getlist('screenshot'))
+        failed = [result for result in results if 'error' in result]
+        for result in failed:
+            flash('{0}: {1}'.format(result['name'], result['error']), 'error')
+        if results and not failed:
+            if len(results) == 1:
+                flash('Screenshot uploaded.', 'success')
+            else:
+                flash('{0} screenshots uploaded.'.format(len(results)),
+                      'success')
             return redirect(url_for('show_screenshots'))
-        else:
+        elif not results:
             flash('Uploads of this filetype not allowed.', 'error')
     return render_template('upload_screenshot.html')
 
+@app.route('/api/upload', methods=['POST'])
+@token_required()
+def api_upload_screenshot():
+    """
+    Upload for scripted clients. Takes any number of ``screenshot`` files
+    and answers with the result of each; a single upload also gets its
+    ``filename`` and ``url`` at the top level.
+
+    """
+    results = store_uploads(request.files.getlist('screenshot'))
+    if not results:
+        return api_error('No screenshot uploaded.', 400)
+    if len(results) == 1:
+        if 'error' in results[0]:
+            return api_error(results[0]['error'], 400)
+        return jsonify(user=g.user['name'], screenshots=results,
+                       filename=results[0]['filename'], url=results[0]['url'])
+    return jsonify(user=g.user['name'], screenshots=results)
+
+@app.route('/api/probe', methods=['POST'])
+@token_required()
+def api_probe_screenshots():
+    """
+    Tells scripted clients which files they don't need to upload. Takes a
+    JSON list of ``{"name", "size", "sha256"}`` objects and answers with
+    the names the user already has with the same content as uploaded,
+    compared by hash if the client sent one and by size otherwise. Files
+    stored without a hash are compared by size until a job hashed them.
+
+    """
+    try:
+        files = request.json['files']
+    except (ValueError, TypeError, KeyError):
+        files = None
+    if not isinstance(files, list) or \
+            not all(isinstance(file, dict) and
+                    isinstance(file.get('name'), basestring)
+                    for file in files):
+        return api_error('Expected {"files": [{"name": ..., "size": ..., '
+                         '"sha256": ...}, ...]}.', 400)
+    existing = []
+    unhashed = False
+    for file in files:
+        filename = secure_filename(file['name'])
+        shot = query_db('select id, size, original_size, '
+                        'coalesce(original_hash, hash) as hash '
+                        'from screenshots where user=? and filename=?',
+                        [g.user['name'], filename], one=True)
+        if shot is None:
+            continue
+        size = shot['original_size'] if shot['original_size'] is not None \
+               else shot['size']
+        if size != file.get('size'):
+            continue
+        if not file.get('sha256'):
+            existing.append(file['name'])
+            continue
+        if shot['hash'] is None:
+            if shot['size'] == size:
+                # stored without content-addressing and not optimized
+                # since, hashing it is left to a job
+                unhashed = True
+                existing.append(file['name'])
+        elif shot['hash'] == file['sha256']:
+            existing.append(file['name'])
+    if unhashed:
+        db = get_db()
+        jobs.enqueue(db, 'backfill_hashes', {'user': g.user['name']},
+                     key='backfill_hashes:{0}'.format(g.user['name']))
+        db.commit()
+    return jsonify(existing=existing)
+
 @app.route('/<user>/delete/<shot>')
 @login_required("You need to be logged in in order to delete screenshots.")
 def delete_screenshot(user, shot):
@@ -239,9 +1304,11 @@ def delete_screenshot(user, shot):
         flash("You can only delete your own screenshots.", 'notice')
         return redirect(url_for('show_screenshots'))
     if not os.path.exists(filename):
+        _remove_screenshot(user, shot)
         flash("Screenshot '{0}' does not exist.".format(shot), 'error')
         return redirect(url_for('show_screenshots'))
-    os.remove(filename)
+    storage.remove(filename, _remove_screenshot(user, shot))
+    derivatives.remove_derivatives(user, shot)
     flash('Screenshot removed.', 'success')
     return redirect(url_for('show_screenshots'))
 
@@ -250,7 +1317,16 @@ def delete_screenshot(user, shot):
 @admin_required()
 def show_users():
     users = query_db('select * from users')
-    return render_template('show_users.html', users=users) 
+    api_tokens = {}
+    for token in query_db('select * from api_tokens order by created'):
+        api_tokens.setdefault(token['user'], []).append(token)
+    stats = query_db('select result from jobs where kind=? and state=? '
+                     'order by finished desc limit 1',
+                     ['storage_stats', jobs.DONE], one=True)
+    return render_template('show_users.html', users=users,
+                           api_tokens=api_tokens,
+                           jobs=jobs.recent(get_db()),
+                           stats=stats and json.loads(stats['result']))
 
 @app.route('/users/add', methods=['POST'])
 @login_required()
@@ -269,9 +1345,98 @@ def delete_user(name):
         flash('User does not exist.', 'error')
     else:
         _delete_user(name)
-        flash('User deleted.', 'success')
+        flash('User deleted, the screenshots are removed in the background.',
+              'success')
+    return redirect(url_for('show_users'))
+
+@app.route('/users/<name>/quota', methods=['POST'])
+@login_required()
+@admin_required()
+def set_quota(name):
+    quota = request.form.get('quota', '').strip()
+    try:
+        quota = int(float(quota) * 1024 * 1024) if quota else None
+    except ValueError:
+        flash('The quota must be a number of megabytes.', 'error')
+        return redirect(url_for('show_users'))
+    db = get_db()
+    db.execute('update users set quota=? where name=?', [quota, name])
+    db.commit()
+    flash('Quota of {0} changed.'.format(name), 'success')
+    return redirect(url_for('show_users'))
+
+@app.route('/jobs', methods=['POST'])
+@login_required()
+@admin_required()
+def enqueue_job():
+    kind = request.form.get('kind')
+    if kind == 'import_screenshots':
+        user, path = request.form['user'], request.form['path']
+        if not user_exists(user):
+            flash('User does not exist.', 'error')
+            return redirect(url_for('show_users'))
+        if not os.path.isdir(path):
+            flash("Directory '{0}' does not exist.".format(path), 'error')
+            return redirect(url_for('show_users'))
+        id = jobs.enqueue(get_db(), kind, {'user': user, 'path': path},
+                          key='{0}:{1}:{2}'.format(kind, user, path))
+    elif kind in ('rescan_screenshots', 'storage_stats'):
+        id = jobs.enqueue(get_db(), kind, key=kind)
+    else:
+        abort(400)
+    get_db().commit()
+    flash('Job #{0} queued.'.format(id), 'success')
+    return redirect(url_for('show_users'))
+
+@app.route('/jobs/<int:id>/retry', methods=['POST'])
+@login_required()
+@admin_required()
+def retry_job(id):
+    jobs.retry(get_db(), id)
+    flash('Job #{0} queued again.'.format(id), 'success')
+    return redirect(url_for('show_users'))
+
+@app.route('/users/<name>/tokens', methods=['POST'])
+@login_required()
+@admin_required()
+def issue_token(name):
+    if not user_exists(name):
+        flash('User does not exist.', 'error')
+    else:
+        token = _issue_token(name)
+        flash('New API token for {0}: {1}'.format(name, token), 'success')
+    return redirect(url_for('show_users'))
+
+@app.route('/users/<name>/tokens/<int:id>/revoke', methods=['POST'])
+@login_required()
+@admin_required()
+def revoke_token(name, id):
+    _revoke_token(name, id)
+    flash('API token revoked.', 'success')
     return redirect(url_for('show_users'))
 
+@app.route('/metrics')
+def show_metrics():
+    """
+    The metrics of this process in the Prometheus text format. Only for
+    admins, who can also authenticate with an API token in the
+    ``X-Api-Token`` or ``Authorization: Bearer`` header, as scrapers do.
+
+    """
+    user = g.user
+    if user is None:
+        token = request.headers.get('X-Api-Token')
+        authorization = request.headers.get('Authorization', '')
+        if token is None and authorization.startswith('Bearer '):
+            token = authorization[7:].strip()
+        if token:
+            user = user_for_token(token)
+    if user is None or not user['admin']:
+        abort(403)
+    return app.response_class(
+        registry.exposition(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     error = None
@@ -281,10 +1446,11 @@ def login():
                         one=True)
         if user is None:
             error = 'Invalid username.'
-        elif not check_password_hash(user['password'],request.form['password']):
+        elif not check_password(user, request.form['password']):
             error = 'Invalid password.'
         else:
-            g.session['user'] = user
+            g.session['user'] = session_user(user)
+            session.permanent = True
             flash('You were logged in.', 'success')
             if 'next' in request.args:
                 return redirect(request.args['next'])
@@ -295,6 +1461,7 @@ def login():
 @app.route('/logout')
 def logout():
     session.pop('sid', None)
+    session.pop('user', None)
     flash('You were logged out.', 'success')
     return redirect(url_for('show_screenshots'))
 
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic storage
+    ~~~~~~
+
+    With ``STORAGE = 'content-addressed'`` every distinct screenshot is
+    stored once, as a blob named by the SHA-256 of its contents under a
+    sharded ``BLOBS_DIR/ab/cd/<hash>`` tree. The per-user files are hard
+    links to the blobs, so everything that reads screenshots keeps working
+    unchanged, and the link count of a blob is its reference count: a blob
+    is removed once no user file links to it anymore.
+
+    With the default ``STORAGE = 'directories'`` uploads are plain files in
+    the user directories.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import errno
+import hashlib
+
+# configuration
+import config
+import multipart
+
+
+def content_addressed():
+    return config.STORAGE == 'content-addressed'
+
+def blob_path(hash):
+    return os.path.join(config.BLOBS_DIR, hash[:2], hash[2:4], hash)
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class HashingFile(object):
+    """A file wrapper that hashes everything written to it."""
+
+    def __init__(self, file):
+        self.__dict__['file'] = file
+        self.__dict__['hash'] = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.file, name, value)
+
+
+def spool_file(directory):
+    """
+    Like :func:`multipart.spool_file`, but the upload is hashed while it
+    is written when content-addressed storage is enabled.
+
+    """
+    file = multipart.spool_file(directory)
+    if content_addressed():
+        return HashingFile(file)
+    return file
+
+def hash_file(path):
+    """Returns the SHA-256 of a file on disk."""
+    hash = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            hash.update(chunk)
+    finally:
+        f.close()
+    return hash.hexdigest()
+
+def _link(blob, target):
+    """Atomically makes ``target`` a hard link of ``blob``."""
+    tmp = os.path.join(os.path.dirname(target), '.link-{0}-{1}'.format(
+        os.path.basename(target), os.urandom(4).encode('hex')))
+    os.link(blob, tmp)
+    os.rename(tmp, target)
+
+def store(file, target):
+    """
+    Stores an uploaded :class:`~werkzeug.FileStorage` at ``target`` and
+    returns the hash of its blob, None without content-addressed storage.
+
+    """
+    if not content_addressed():
+        multipart.save_upload(file, target)
+        return None
+
+    if isinstance(file.stream, HashingFile):
+        hash = file.stream.hexdigest()
+    else:
+        file.stream.seek(0)
+        hash = hashlib.sha256()
+        for chunk in iter(lambda: file.stream.read(64 * 1024), ''):
+            hash.update(chunk)
+        hash = hash.hexdigest()
+        file.stream.seek(0)
+
+    # the upload goes into place first, so it is not lost if the blob is
+    # released while we link to it
+    multipart.save_upload(file, target)
+    adopt(target, hash)
+    return hash
+
+def adopt(path, hash):
+    """
+    Turns an existing file into a reference to the blob of ``hash``,
+    creating the blob from the file if there is none yet.
+
+    """
+    blob = blob_path(hash)
+    _makedirs(os.path.dirname(blob))
+    while True:
+        try:
+            os.link(path, blob)
+            return
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            if not os.path.samefile(path, blob):
+                _link(blob, path)
+            return
+        except OSError, e:
+            # the blob was released by someone else meanwhile, the file
+            # becomes the blob then
+            if e.errno != errno.ENOENT:
+                raise
+
+def release(hash):
+    """Removes the blob of ``hash`` if nothing references it anymore."""
+    if hash is None:
+        return
+    blob = blob_path(hash)
+    try:
+        if os.stat(blob).st_nlink <= 1:
+            os.remove(blob)
+    except OSError:
+        pass
+
+def remove(path, hash):
+    """Removes a stored screenshot and, if it was the last one, its blob."""
+    os.remove(path)
+    release(hash)
+
+def trash(path):
+    """
+    Renames ``path`` to a hidden name next to it, so it can be removed in
+    the background while its name is free again right away. Returns the
+    new path, or None if there is nothing at ``path``.
+
+    """
+    target = os.path.join(os.path.dirname(path), '.trash-{0}-{1}'.format(
+        os.path.basename(path), os.urandom(4).encode('hex')))
+    try:
+        os.rename(path, target)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return target
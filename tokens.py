@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic API tokens
+    ~~~~~~
+
+    Tokens let scripted clients upload without sending a password. Only a
+    hash of each token is stored, and verified tokens are remembered for a
+    short while so repeated uploads skip the database lookup.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def generate_token():
+    """Returns a new random token."""
+    return os.urandom(20).encode('hex')
+
+def hash_token(token):
+    """Returns the hash a token is stored and looked up by."""
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+class TokenCache(object):
+    """
+    Maps token hashes to the session user of their owner for ``ttl``
+    seconds, keeping at most ``max_entries`` of them. Revoking a token
+    only evicts it from the cache of the current process, other processes
+    notice once the entry expired.
+
+    """
+
+    def __init__(self, ttl=60, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token_hash):
+        """Returns the cached user of a token, or None."""
+        with self._lock:
+            entry = self._entries.get(token_hash)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < time.time():
+                del self._entries[token_hash]
+                return None
+            return user
+
+    def set(self, token_hash, user):
+        with self._lock:
+            self._entries.pop(token_hash, None)
+            self._entries[token_hash] = (user, time.time() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, token_hash):
+        with self._lock:
+            self._entries.pop(token_hash, None)
+
+    def discard_user(self, name):
+        """Evicts all tokens of a user, e.g. when the user is deleted."""
+        with self._lock:
+            for token_hash, (user, expires) in self._entries.items():
+                if user['name'] == name:
+                    del self._entries[token_hash]
@@ -8,18 +8,73 @@ activate_this = "env/bin/activate_this.py"
 if os.path.exists(activate_this):
     execfile(activate_this, dict(__file__=activate_this))
 
-import tornado.httpserver
-import tornado.ioloop
+import time
+import signal
+
 import tornado.options
-import tornado.wsgi
 from tornado.options import define, options
 
-from shotomatic import app
+import config
+import prefork
+
+
+def serve(listener):
+    """
+    Serves the app on ``listener``, a socket or a port, until SIGTERM and
+    then stops once the requests in progress are done.
+
+    """
+    # imported here, so that every worker loads the app after the fork
+    import tornado.ioloop
+    from storage import spool_file
+    from shotomatic import app
+    from tornado_wsgi import ThreadPoolWSGIContainer, StreamingHTTPServer
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    container = ThreadPoolWSGIContainer(app, threads=config.TORNADO_THREADS)
+    http_server = StreamingHTTPServer(
+        container, lambda: spool_file(config.SCREENSHOTS_DIR),
+        max_upload_size=config.MAX_UPLOAD_SIZE)
+    if isinstance(listener, int):
+        http_server.listen(listener)
+    else:
+        http_server.add_socket(listener)
+
+    def stop():
+        http_server.stop_accepting()
+        deadline = time.time() + config.GRACEFUL_TIMEOUT
+        def check():
+            if container.active <= 0 or time.time() > deadline:
+                io_loop.stop()
+        tornado.ioloop.PeriodicCallback(check, 100, io_loop=io_loop).start()
+
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: io_loop.add_callback(stop))
+    io_loop.start()
+
+def reload_config():
+    # restored if the new settings can't be used, workers that die are
+    # replaced with the old ones then
+    settings = dict(vars(config))
+    reload(config)
+    problems = prefork.check_config()
+    if problems:
+        vars(config).update(settings)
+        raise RuntimeError('; '.join(problems))
+    return config.SERVER_WORKERS
 
 if __name__ == "__main__":
     define("port", default=5000, help="run on the given port", type=int)
     tornado.options.parse_command_line()
-    container = tornado.wsgi.WSGIContainer(app)
-    http_server = tornado.httpserver.HTTPServer(container)
-    http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    if config.SERVER_WORKERS > 0:
+        problems = prefork.check_config()
+        if problems:
+            raise SystemExit('Cannot serve with SERVER_WORKERS > 0:\n' +
+                             '\n'.join(problems))
+        master = prefork.Master(prefork.listen(options.port), serve,
+                                workers=config.SERVER_WORKERS,
+                                graceful_timeout=config.GRACEFUL_TIMEOUT,
+                                on_reload=reload_config)
+        master.run()
+    else:
+        serve(options.port)
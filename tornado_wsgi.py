@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+    Shot-O-matic on Tornado
+    ~~~~~~
+
+    A WSGI container for Tornado's HTTP server that writes the response
+    body to the client chunk by chunk, instead of joining it into one
+    string first like ``tornado.wsgi.WSGIContainer`` does, and an HTTP
+    server that spools uploads to disk while they arrive instead of reading
+    the whole request body into memory. Either way only about one chunk
+    per connection is held in memory. :class:`ThreadPoolWSGIContainer`
+    also runs the application in a pool of threads, so the IOLoop keeps
+    accepting connections and streaming responses meanwhile.
+
+    :copyright: (c) 2010 by Aljoscha Krettek.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import fcntl
+import errno
+import Queue
+import socket
+import logging
+import threading
+from collections import deque
+
+import tornado.wsgi
+from tornado import escape, ioloop, iostream
+from tornado.httpserver import HTTPServer, HTTPConnection, HTTPRequest, \
+     HTTPHeaders
+from werkzeug.http import parse_options_header
+
+from multipart import MultipartParser
+
+
+class StreamingWSGIContainer(tornado.wsgi.WSGIContainer):
+    """
+    Drop-in replacement for ``tornado.wsgi.WSGIContainer``. Responses that
+    carry a Content-Length are streamed, the next chunk being fetched from
+    the application only once the previous one went out to the socket.
+    Responses without one are buffered as before to compute it.
+
+    """
+
+    def __call__(self, request):
+        self._send(request, *self._run_application(self._environ(request)))
+
+    def _run_application(self, environ):
+        """
+        Calls the application and returns the status, the headers, the
+        iterator over the body chunks and the response to close after.
+
+        """
+        data = {}
+        def start_response(status, response_headers, exc_info=None):
+            data["status"] = status
+            data["headers"] = HTTPHeaders(response_headers)
+        app_response = self.wsgi_application(environ, start_response)
+        if not data: raise Exception("WSGI app did not call start_response")
+
+        headers = data["headers"]
+        if "Content-Length" in headers:
+            chunks = iter(app_response)
+        else:
+            try:
+                body = escape.utf8("".join(app_response))
+            finally:
+                if hasattr(app_response, "close"):
+                    app_response.close()
+            headers["Content-Length"] = str(len(body))
+            chunks = app_response = iter([body])
+        headers.setdefault("Content-Type", "text/html; charset=UTF-8")
+        headers.setdefault("Server", "TornadoServer/0.1")
+        return data["status"], headers, chunks, app_response
+
+    def _send(self, request, status, headers, chunks, app_response):
+        parts = ["HTTP/1.1 " + status + "\r\n"]
+        for key, value in headers.iteritems():
+            parts.append(escape.utf8(key) + ": " + escape.utf8(value) + "\r\n")
+        parts.append("\r\n")
+        self._stream_body(request, "".join(parts), chunks, app_response,
+                          int(status.split()[0]))
+
+    def _stream_body(self, request, head, chunks, app_response, status_code):
+        stream = request.connection.stream
+
+        def close():
+            stream.set_close_callback(None)
+            if hasattr(app_response, "close"):
+                app_response.close()
+            self._response_finished(request)
+
+        def finish():
+            close()
+            request.finish()
+            self._log(status_code, request)
+
+        def write_next(head=""):
+            if stream.closed():
+                return
+            for chunk in chunks:
+                if chunk:
+                    stream.write(head + escape.utf8(chunk), write_next)
+                    return
+            if head:
+                stream.write(head, finish)
+            else:
+                finish()
+
+        # the client may go away in the middle of the body
+        stream.set_close_callback(close)
+        # the head goes out with the first chunk, as a segment of its own
+        # would wait for the client's delayed ACK
+        write_next(head)
+
+    def _response_finished(self, request):
+        """Called once a response was sent or the client went away."""
+        pass
+
+    def _environ(self, request):
+        environ = tornado.wsgi.WSGIContainer._environ(self, request)
+        spooled_form = getattr(request, "spooled_form", None)
+        if spooled_form is not None:
+            environ["shotomatic.form"], environ["shotomatic.files"] = \
+                spooled_form
+        return environ
+
+
+class ThreadPoolWSGIContainer(StreamingWSGIContainer):
+    """
+    Calls the application in one of ``threads`` threads. The response is
+    written by the IOLoop once the application returned it, body chunks
+    are still fetched one at a time as the previous one went out.
+
+    """
+
+    def __init__(self, wsgi_application, threads=10, io_loop=None):
+        StreamingWSGIContainer.__init__(self, wsgi_application)
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        #: requests handed to the application that are not finished yet
+        self.active = 0
+        self._jobs = Queue.Queue()
+        self._done = deque()
+        self._wake_reader, self._wake_writer = os.pipe()
+        for fd in (self._wake_reader, self._wake_writer):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.io_loop.add_handler(self._wake_reader, self._on_done,
+                                 self.io_loop.READ)
+        for i in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def __call__(self, request):
+        self.active += 1
+        self._jobs.put((request, self._environ(request)))
+
+    def _environ(self, request):
+        environ = StreamingWSGIContainer._environ(self, request)
+        environ["wsgi.multithread"] = True
+        return environ
+
+    def _work(self):
+        while True:
+            request, environ = self._jobs.get()
+            try:
+                result = self._run_application(environ)
+            except Exception:
+                logging.error("Error in WSGI application", exc_info=True)
+                result = None
+            # deque operations are atomic, the pipe wakes the IOLoop up
+            self._done.append((request, result))
+            try:
+                os.write(self._wake_writer, "x")
+            except OSError:
+                pass
+
+    def _on_done(self, fd, events):
+        try:
+            while os.read(self._wake_reader, 4096):
+                pass
+        except OSError:
+            pass
+        while self._done:
+            request, result = self._done.popleft()
+            if result is None:
+                result = ("500 Internal Server Error",
+                          HTTPHeaders({"Content-Length": "0"}), iter([]), None)
+            if request.connection.stream.closed():
+                if hasattr(result[3], "close"):
+                    result[3].close()
+                self._response_finished(request)
+                continue
+            self._send(request, *result)
+
+    def _response_finished(self, request):
+        self.active -= 1
+
+
+class StreamingHTTPConnection(HTTPConnection):
+    """
+    Reads ``multipart/form-data`` bodies in chunks and feeds them to a
+    :class:`~multipart.MultipartParser`, which writes the file parts to
+    streams from ``stream_factory``. The parsed form is handed on as the
+    ``spooled_form`` attribute of the request. Other requests are read as
+    usual.
+
+    """
+
+    def __init__(self, stream, address, request_callback, no_keep_alive=False,
+                 xheaders=False, stream_factory=None,
+                 max_upload_size=100 * 1024 * 1024, chunk_size=64 * 1024):
+        self.stream_factory = stream_factory
+        self.max_upload_size = max_upload_size
+        self.chunk_size = chunk_size
+        self._parser = None
+        self._remaining = 0
+        HTTPConnection.__init__(self, stream, address, request_callback,
+                                no_keep_alive, xheaders)
+
+    def _on_headers(self, data):
+        eol = data.find("\r\n")
+        start_line = data[:eol]
+        method, uri, version = start_line.split(" ")
+        headers = HTTPHeaders.parse(data[eol:])
+        content_type, options = parse_options_header(
+            headers.get("Content-Type", ""))
+        content_length = int(headers.get("Content-Length") or 0)
+        if (method != "POST" or not content_length or
+                content_type != "multipart/form-data" or
+                not options.get("boundary")):
+            return HTTPConnection._on_headers(self, data)
+        if not version.startswith("HTTP/"):
+            raise Exception("Malformed HTTP version in HTTP Request-Line")
+        if content_length > self.max_upload_size:
+            raise Exception("Content-Length too long")
+
+        self._request = HTTPRequest(
+            connection=self, method=method, uri=uri, version=version,
+            headers=headers, remote_ip=self.address[0])
+        self._parser = MultipartParser(options["boundary"],
+                                       self.stream_factory)
+        self._remaining = content_length
+        if headers.get("Expect") == "100-continue":
+            self.stream.write("HTTP/1.1 100 (Continue)\r\n\r\n")
+        self._read_chunk()
+
+    def _read_chunk(self):
+        self.stream.read_bytes(min(self.chunk_size, self._remaining),
+                               self._on_chunk)
+
+    def _on_chunk(self, data):
+        self._remaining -= len(data)
+        try:
+            self._parser.feed(data)
+            if self._remaining > 0:
+                self._read_chunk()
+                return
+            self._request.spooled_form = self._parser.finish()
+        except ValueError, e:
+            logging.warning("Invalid multipart/form-data: %s", e)
+            self._parser.close()
+            self._parser = None
+            self.stream.close()
+            return
+        self._parser = None
+        self.request_callback(self._request)
+
+
+class StreamingHTTPServer(HTTPServer):
+    """
+    An HTTP server that spools uploads with :class:`StreamingHTTPConnection`.
+    ``stream_factory`` is called without arguments for every uploaded file
+    and must return a writable, seekable file object.
+
+    """
+
+    def __init__(self, request_callback, stream_factory,
+                 max_upload_size=100 * 1024 * 1024, **kwargs):
+        HTTPServer.__init__(self, request_callback, **kwargs)
+        self.stream_factory = stream_factory
+        self.max_upload_size = max_upload_size
+
+    def add_socket(self, sock):
+        """Accepts connections on an already listening socket."""
+        assert not self._socket
+        self._socket = sock
+        sock.setblocking(0)
+        self.io_loop.add_handler(sock.fileno(), self._handle_events,
+                                 self.io_loop.READ)
+
+    def stop_accepting(self):
+        """Stops accepting new connections, open ones are still served."""
+        if self._socket is not None:
+            self.io_loop.remove_handler(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+
+    def _handle_events(self, fd, events):
+        while True:
+            try:
+                connection, address = self._socket.accept()
+            except socket.error, e:
+                if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            try:
+                # bodies are written in chunks as they are produced
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                      1)
+                stream = iostream.IOStream(connection, io_loop=self.io_loop)
+                StreamingHTTPConnection(stream, address, self.request_callback,
+                                        self.no_keep_alive, self.xheaders,
+                                        self.stream_factory,
+                                        self.max_upload_size)
+            except:
+                logging.error("Error in connection callback", exc_info=True)
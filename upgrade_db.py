@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+"""
+Create the tables and indexes that were added to the schema since the
+database was initialized, keeping all existing data.
+
+"""
+from __future__ import with_statement
+
+from contextlib import closing
+
+import shotomatic
+
+if __name__ == "__main__":
+    with closing(shotomatic.connect_db()) as db:
+        shotomatic.upgrade_db(db)
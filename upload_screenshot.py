@@ -1,20 +1,201 @@
 #!/usr/bin/env python
 """
-Upload a screenshot to the specified shot-O-matic website
+Upload screenshots to the specified shot-O-matic website, either with
+username and password or with an API token issued on the users page.
 Example usage:
     ./upload_screenshot.py http://shots.foo/upload /path/to/file admin default
+    ./upload_screenshot.py http://shots.foo/api/upload /path/to/file TOKEN
+
+With --token any number of files, directories and glob patterns can be
+uploaded at once. Files the server already has are skipped, the rest is
+sent in batches over several parallel keep-alive connections:
+    ./upload_screenshot.py --token TOKEN --parallel 4 \\
+        http://shots.foo/api/upload ~/captures '/old/shots/*.png'
 
 """
+import os
 import sys
+import glob
+import json
+import time
+import Queue
+import hashlib
+import threading
+from optparse import OptionParser
+from cStringIO import StringIO
 
 import pycurl
 
-if __name__ == "__main__":
-    url = sys.argv[1]
-    filename = sys.argv[2]
-    username = sys.argv[3]
-    password = sys.argv[4]
-    print "Uploading {0} to {1}".format(filename, url)
+# what the server takes by default (ALLOWED_EXTENSIONS), directories are
+# searched for these only
+EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+
+class Uploader(object):
+    """
+    Posts to the server over one reused curl handle, and therefore over
+    one keep-alive connection, retrying failed requests with backoff.
+
+    """
+
+    def __init__(self, token, retries=3):
+        self.token = token
+        self.retries = retries
+        self.curl = pycurl.Curl()
+
+    def post(self, url, form=None, data=None):
+        """Returns the decoded JSON answer of the server."""
+        for attempt in range(self.retries + 1):
+            try:
+                status, body = self._perform(url, form, data)
+            except pycurl.error, e:
+                error = e[1]
+            else:
+                if status < 500:
+                    try:
+                        return json.loads(body)
+                    except ValueError:
+                        # e.g. an HTML error page, asking again won't help
+                        raise IOError('{0} failed: HTTP {1}'.format(url,
+                                                                   status))
+                error = 'HTTP {0}'.format(status)
+            if attempt < self.retries:
+                time.sleep(0.5 * 2 ** attempt)
+        raise IOError('{0} failed: {1}'.format(url, error))
+
+    def _perform(self, url, form, data):
+        c = self.curl
+        c.reset()
+        body = StringIO()
+        headers = ["X-Api-Token: " + self.token, "Expect:"]
+        c.setopt(c.URL, url)
+        c.setopt(c.WRITEFUNCTION, body.write)
+        if form is not None:
+            c.setopt(c.HTTPPOST, form)
+        else:
+            c.setopt(c.POSTFIELDS, data)
+            headers.append("Content-Type: application/json")
+        c.setopt(c.HTTPHEADER, headers)
+        c.perform()
+        return c.getinfo(c.RESPONSE_CODE), body.getvalue()
+
+    def close(self):
+        self.curl.close()
+
+
+def is_image(name):
+    return '.' in name and name.rsplit('.', 1)[1].lower() in EXTENSIONS
+
+def collect(patterns):
+    """
+    Expands files, directories and glob patterns into a list of files. Of
+    the files in directories only the images are taken.
+
+    """
+    files = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            if os.path.isdir(path):
+                for root, dirs, names in os.walk(path):
+                    dirs.sort()
+                    files.extend(os.path.join(root, name)
+                                 for name in sorted(names) if is_image(name))
+            elif os.path.isfile(path):
+                files.append(path)
+    seen = set()
+    return [path for path in files
+            if not (path in seen or seen.add(path))]
+
+def sha256(path):
+    hash = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            hash.update(chunk)
+    finally:
+        f.close()
+    return hash.hexdigest()
+
+def probe(uploader, url, files, chunk_size=500):
+    """
+    Returns the files the server does not have yet. Raises IOError if the
+    server refuses to answer, e.g. for a bad token.
+
+    """
+    missing = []
+    for start in range(0, len(files), chunk_size):
+        chunk = files[start:start + chunk_size]
+        data = json.dumps({'files': [{'name': os.path.basename(path),
+                                      'size': os.path.getsize(path),
+                                      'sha256': sha256(path)}
+                                     for path in chunk]})
+        answer = uploader.post(url, data=data)
+        if 'existing' not in answer:
+            raise IOError(answer.get('error', 'probe failed'))
+        existing = set(answer['existing'])
+        missing.extend(path for path in chunk
+                       if os.path.basename(path) not in existing)
+    return missing
+
+def make_batches(files, batch_size, batch_bytes):
+    """
+    Groups files into batches of at most ``batch_size`` files and, unless
+    a single file is larger, ``batch_bytes`` bytes.
+
+    """
+    batches = []
+    batch, size = [], 0
+    for path in files:
+        file_size = os.path.getsize(path)
+        if batch and (len(batch) >= batch_size or
+                      size + file_size > batch_bytes):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(path)
+        size += file_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def upload_all(url, token, files, parallel, batch_size, batch_bytes, retries):
+    batches = Queue.Queue()
+    for batch in make_batches(files, batch_size, batch_bytes):
+        batches.put(batch)
+    lock = threading.Lock()
+    failures = []
+
+    def work():
+        uploader = Uploader(token, retries)
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except Queue.Empty:
+                break
+            form = [("screenshot", (pycurl.FORM_FILE, path))
+                    for path in batch]
+            try:
+                results = uploader.post(url, form=form)
+                if 'screenshots' not in results:
+                    raise IOError(results.get('error', 'upload failed'))
+            except IOError, e:
+                results = {'screenshots': [{'error': str(e)}] * len(batch)}
+            with lock:
+                for path, result in zip(batch, results['screenshots']):
+                    if 'error' in result:
+                        failures.append(path)
+                        print "{0}: {1}".format(path, result['error'])
+                    else:
+                        print "{0} -> {1}".format(path, result['url'])
+        uploader.close()
+
+    threads = [threading.Thread(target=work) for i in range(parallel)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
+def upload_with_password(url, filename, username, password):
     c = pycurl.Curl()
     c.setopt(c.POST, 1)
     c.setopt(c.URL, url)
@@ -25,4 +206,54 @@ if __name__ == "__main__":
     c.setopt(c.VERBOSE, 0)
     c.perform()
     c.close()
-    print "\nDone."
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] URL FILE USERNAME PASSWORD\n"
+                                "       %prog [options] URL FILE TOKEN\n"
+                                "       %prog --token TOKEN [options] "
+                                "URL PATH...")
+    parser.add_option("--token", help="API token to upload with")
+    parser.add_option("--parallel", type="int", default=4,
+                      help="number of parallel connections [%default]")
+    parser.add_option("--batch", type="int", default=10,
+                      help="files per request [%default]")
+    parser.add_option("--batch-bytes", type="int", default=10 * 1024 * 1024,
+                      help="bytes per request, keep it below the server's "
+                           "MAX_UPLOAD_SIZE [%default]")
+    parser.add_option("--retries", type="int", default=3,
+                      help="retries of failed requests [%default]")
+    parser.add_option("--no-skip", action="store_false", dest="skip",
+                      default=True,
+                      help="upload files the server already has, too")
+    options, args = parser.parse_args()
+
+    if options.token is None:
+        if len(args) == 4:
+            url, filename, username, password = args
+            print "Uploading {0} to {1}".format(filename, url)
+            upload_with_password(url, filename, username, password)
+            print "\nDone."
+            sys.exit(0)
+        elif len(args) == 3:
+            url, filename, options.token = args
+            args = [url, filename]
+        else:
+            parser.error("either give an API token or username and password")
+    if len(args) < 2:
+        parser.error("give the upload URL and what to upload")
+
+    url = args[0]
+    files = collect(args[1:])
+    if options.skip:
+        uploader = Uploader(options.token, options.retries)
+        try:
+            files = probe(uploader, url.rsplit('/', 1)[0] + '/probe', files)
+        except IOError, e:
+            sys.exit("Probing failed: {0}".format(e))
+        finally:
+            uploader.close()
+    print "Uploading {0} files to {1}".format(len(files), url)
+    failures = upload_all(url, options.token, files, options.parallel,
+                          options.batch, options.batch_bytes, options.retries)
+    print "Done, {0} failed.".format(len(failures))
+    sys.exit(1 if failures else 0)